@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregations behind the plots of graphics.py.
+
+Every function takes a climate object and returns the numbers a plot draws,
+computed with grouped reductions on integer date keys. This module only
+needs numpy and pandas, so the numbers can be computed, cached and
+benchmarked without matplotlib.
+"""
+
+import calendar
+import os
+
+import numpy as np
+import pandas as pd
+
+import main
+
+
+def _as_list(values):
+    """
+    Wrap a single str or int argument in a list.
+    """
+    if isinstance(values, (str, int, np.integer)):
+        return [values]
+    return values
+
+
+def calendar_matrices(climate, city, years=None):
+    """
+    Shape the daily temperatures of a city into calendar matrices, one 6x7
+    matrix (weeks x weekdays) per month and year. The calendar coordinates of
+    every day are computed with array arithmetic and the matrices are filled
+    with a single scatter.
+
+    Args:
+        climate: climate object.
+        city: city name in capital letters (str).
+        years: list of years (int), all of them by default.
+
+    Returns:
+        a tuple (day_nums, day_vals) of (years x 12 x 6 x 7) np arrays with
+        the day numbers and the temperatures of each day, NaN where there is
+        no record.
+    """
+    if years is None:
+        years = climate.get_years()
+    temps = climate.filter_by(cities=[city], years=years)
+    dates = temps.index
+
+    year = pd.Index(years).get_indexer(dates.year)
+    month = dates.month.to_numpy() - 1
+    day = dates.day.to_numpy()
+    col = dates.dayofweek.to_numpy()
+    first = (col - day + 1) % 7  # weekday of the first day of the month
+    row = (day - 1 + first) // 7
+
+    day_nums = np.full((len(years), 12, 6, 7), np.nan)
+    day_vals = np.full((len(years), 12, 6, 7), np.nan)
+    day_nums[year, month, row, col] = day  # day number (0-31)
+    day_vals[year, month, row, col] = temps.values  # day value (the heatmap data)
+    return day_nums, day_vals
+
+
+def heat_map_cube(climate, cities=None):
+    """
+    Compute the monthly mean temperatures of several cities at once, from
+    the monthly totals cached on the climate object (see
+    Climate.monthly_totals).
+
+    Args:
+        climate: a climate object.
+        cities: list of city names, all of them by default.
+
+    Returns:
+        a tuple (cities, years, means) where means is a (cities x years x 12)
+        np array, NaN where there are no records.
+    """
+    totals = climate.monthly_totals()
+    cities = totals['cities'] if cities is None else _as_list(cities)
+    assert set(cities).issubset(totals['cities']), "provided city is not available"
+    rows = [totals['cities'].index(city) for city in cities]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = totals['sum'][rows] / totals['count'][rows]
+    return cities, totals['years'], means
+
+
+def heat_map_data(climate, city, cube=None):
+    """
+    Compute the monthly mean temperatures plotted by graphics.heat_map.
+
+    Args:
+        climate: a climate object.
+        city: city name in capital letters (str).
+        cube: the result of heat_map_cube for several cities including city.
+            By default, it is computed for city alone.
+
+    Returns:
+        a data frame indexed by MONTH (abbreviation, December first) with
+        a column for each YEAR with records of the city.
+    """
+    cities, years, means = cube or heat_map_cube(climate, [city])
+    means = means[list(cities).index(city)]
+    recorded = ~np.isnan(means).all(axis=1)
+    return pd.DataFrame(means[recorded, ::-1].T,
+                        index=pd.Index(calendar.month_abbr[12:0:-1], name='MONTH'),
+                        columns=pd.Index(years[recorded], name='YEAR'))
+
+
+def yearly_data(climate, city, year):
+    """
+    Compute the daily temperatures plotted by graphics.graph_by_year, along
+    with the historical min, max, mean and std of the city for each day.
+
+    Args:
+        climate: a climate object.
+        city: city name in capital letters (str).
+        year: the year (int).
+
+    Returns:
+        a data frame with the columns DATE, TEMP, t_min, t_max, t_mean and
+        t_std.
+    """
+    history = climate.climatology(city)
+    t_min_max = pd.DataFrame({'t_min': history['min'], 't_max': history['max'],
+                              't_mean': history['mean'], 't_std': history['std']})
+
+    if not calendar.isleap(year):
+        t_min_max = t_min_max.drop(59)  # February 29th
+
+    temps = pd.DataFrame(climate.filter_by(cities=[city], years=[year]))
+    t_min_max.reset_index(inplace=True), temps.reset_index(inplace=True)
+    df = pd.concat([temps, t_min_max[['t_min', 't_max', 't_mean', 't_std']]],
+                   axis=1)
+    return df
+
+
+def _kde_grid(temps, groups, n_groups, n, bw_adjust):
+    """
+    Compute a Gaussian kernel density estimate of the temperatures of each
+    group on a grid of n points. The samples are linearly binned on the grid
+    and the binned counts of all the groups are convolved with their kernels
+    in a single FFT, using the analytic transform of the Gaussian kernel.
+
+    Returns:
+        the grid, the groups x grid densities and the count of each group.
+    """
+    count = np.bincount(groups, minlength=n_groups)
+    total = np.bincount(groups, temps, minlength=n_groups)
+    squares = np.bincount(groups, temps**2, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares - count * mean**2, 0) / (count - 1))
+        # Scott's rule, as the scipy kernel used by seaborn.kdeplot.
+        bandwidth = bw_adjust * std * count ** (-1 / 5)
+
+    # The grid spans the data plus three of the widest bandwidths.
+    spread = 3 * np.nanmax(bandwidth, initial=0)
+    grid = np.linspace(temps.min() - spread, temps.max() + spread, n)
+    step = grid[1] - grid[0]
+
+    # Linear binning of the samples on the grid.
+    pos = np.clip((temps - grid[0]) / step, 0, n - 1)
+    left = np.minimum(pos.astype(int), n - 2)
+    weight = pos - left
+    binned = np.bincount(groups * n + left, 1 - weight, minlength=n_groups * n)
+    binned += np.bincount(groups * n + left + 1, weight, minlength=n_groups * n)
+    binned = binned.reshape(n_groups, n)
+
+    # Zero padding to twice the grid length avoids the circular wrap-around.
+    length = 2 * n
+    freqs = np.fft.rfftfreq(length)
+    sigma = (bandwidth / step)[:, None]
+    kernel = np.exp(-2 * (np.pi * freqs[None, :] * sigma)**2)
+    density = np.fft.irfft(np.fft.rfft(binned, length, axis=1) * kernel,
+                           length, axis=1)[:, :n]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        density = np.maximum(density, 0) / (count[:, None] * step)
+    density[count < 2] = np.nan
+    return grid, density, count
+
+
+def density_grid(climate, cities=None, years=None, gridsize=200, bw_adjust=.5):
+    """
+    Compute the density of the daily temperatures of every city and year on
+    a shared temperature grid, in one vectorised pass (see _kde_grid). The
+    result is cached on the climate object.
+
+    Args:
+        climate: a climate object.
+        cities: list of city names, all of them by default.
+        years: list of years (int), all of them by default.
+        gridsize: number of points of the temperature grid (int).
+        bw_adjust: factor of the bandwidth given by Scott's rule, as in
+            seaborn.kdeplot (float).
+
+    Returns:
+        a dict with the keys 'cities', 'years', 'grid' (np array of the
+        temperatures), 'density' (a cities x years x grid np array, NaN for
+        the cities and years with less than two records), 'count' (a
+        cities x years np array with the number of records) and 'range'
+        (the lowest and highest temperatures, the grid extends beyond them).
+    """
+    cities = climate.get_cities() if cities is None else cities
+    years = climate.get_years() if years is None else years
+    cities = sorted(set(_as_list(cities)))
+    years = sorted({int(year) for year in _as_list(years)})
+
+    def compute():
+        values, groups = [], []
+        for i, city in enumerate(cities):
+            temps = climate.filter_by(cities=[city], years=years)
+            year = pd.Index(years).get_indexer(temps.index.year)
+            values.append(temps.to_numpy(float))
+            groups.append(i * len(years) + year)
+        values = np.concatenate(values)
+        groups = np.concatenate(groups)
+        grid, density, count = _kde_grid(values, groups, len(cities) * len(years),
+                                         gridsize, bw_adjust)
+        return {'cities': cities, 'years': years, 'grid': grid,
+                'density': density.reshape(len(cities), len(years), gridsize),
+                'count': count.reshape(len(cities), len(years)),
+                'range': (np.nanmin(values, initial=np.inf),
+                          np.nanmax(values, initial=-np.inf))}
+
+    key = ('density_grid', tuple(cities), tuple(years), gridsize, bw_adjust)
+    return climate.cached(key, compute)
+
+
+def density_data(climate, cities, years):
+    """
+    Compute the temperature densities plotted by graphics.graphdensity_bycity
+    (see density_grid). With several cities, the density of each year is the
+    mixture of the densities of the cities, weighted by their records.
+
+    Args:
+        climate: a climate object.
+        cities: a str or list of str of cities names in capital letters.
+        years: int or list of years (int)
+
+    Returns:
+        a data frame with the columns YEAR, TEMP (the grid) and DENSITY.
+    """
+    result = density_grid(climate, _as_list(cities), _as_list(years))
+    count = result['count'][:, :, None]
+    density = np.nansum(result['density'] * count, axis=0) / count.sum(axis=0)
+    grid = result['grid']
+    return pd.DataFrame({'YEAR': np.repeat(result['years'], len(grid)),
+                         'TEMP': np.tile(grid, len(result['years'])),
+                         'DENSITY': density.ravel()})
+
+
+def yearly_stats(climate, cities, years=None, percentiles=()):
+    """
+    Compute the statistics of the daily temperatures of the given cities for
+    each year, in a single grouped reduction.
+
+    Args:
+        climate: a climate object.
+        cities: a str or list of str of cities names in capital letters.
+        years: list of years (int), all of them by default.
+        percentiles: the percentiles computed (list of numbers in 0-100).
+
+    Returns:
+        a data frame indexed by YEAR with the columns min, max, mean, std
+        and p<q> for each percentile q.
+    """
+    cities = _as_list(cities)
+    if years is None:
+        temps = climate.filter_by(cities=cities)
+    else:
+        temps = climate.filter_by(cities=cities, years=years)
+    grouped = temps.groupby(temps.index.year.rename('YEAR'))
+    stats = grouped.agg(['min', 'max', 'mean', 'std'])
+    for q in percentiles:
+        stats['p%g' % q] = grouped.quantile(q / 100)
+    return stats
+
+
+def period_data(climate, cities, days, months, years, w_length=1):
+    """
+    Compute the yearly temperatures plotted by graphics.graph_by_period: the
+    mean across the cities for each day of the period, averaged for each
+    year, and smoothed with a moving average of w_length years.
+
+    Args:
+        climate: a climate object.
+        cities: a str or list of str of cities names in capital letters.
+        days: int or list of ints the days
+        months: int or list of ints the months
+        years: list of years (int)
+        w_length: window length in years of the moving average (int).
+
+    Returns:
+        a data frame with the columns YEAR and TEMP.
+    """
+    temps = climate.filter_by(cities=_as_list(cities), days=_as_list(days),
+                              months=_as_list(months), years=years)
+    daily = temps.groupby(level='DATE').mean()
+    y = daily.groupby(daily.index.year).mean().reindex(years).values
+    return pd.DataFrame({'YEAR': years,
+                         'TEMP': main.moving_average(y, w_length)})
+
+
+def std_data(climate, cities, w_length=1):
+    """
+    Compute the yearly extreme temperatures plotted by graphics.graph_std:
+    the min and max temperatures of the cities for each year, smoothed with
+    a moving average of w_length years, and their difference.
+
+    Args:
+        climate: a climate object.
+        cities: a str or list of str of cities names in capital letters.
+        w_length: window length in years of the moving average (int).
+
+    Returns:
+        a data frame with the columns YEAR, MIN, MAX and Delta.
+    """
+    years = climate.get_years()
+    stats = yearly_stats(climate, cities).reindex(years)
+    y, z = main.moving_average(np.vstack([stats['min'], stats['max']]), w_length)
+    return pd.DataFrame({'YEAR': years, 'MIN': y, 'MAX': z, 'Delta': z - y})
+
+
+def _calendar_table(climate, city, w_length):
+    years = climate.get_years()
+    day_nums, day_vals = calendar_matrices(climate, city, years)
+    year, month, row, col = np.nonzero(~np.isnan(day_nums))
+    return pd.DataFrame({'YEAR': np.asarray(years)[year], 'MONTH': month + 1,
+                         'ROW': row, 'WEEKDAY': col,
+                         'DAY': day_nums[year, month, row, col].astype(int),
+                         'TEMP': day_vals[year, month, row, col]})
+
+
+def _heat_map_table(climate, city, w_length):
+    df = heat_map_data(climate, city, heat_map_cube(climate))
+    return df.reset_index().melt(id_vars='MONTH', var_name='YEAR',
+                                 value_name='TEMP')
+
+
+def _yearly_table(climate, city, w_length):
+    history = climate.climatology(city)
+    return pd.DataFrame({'DOY': np.arange(366), 't_min': history['min'],
+                         't_max': history['max'], 't_mean': history['mean'],
+                         't_std': history['std']})
+
+
+def _period_table(climate, city, w_length):
+    return period_data(climate, city, list(range(1, 32)), list(range(1, 13)),
+                       climate.get_years(), w_length)
+
+
+def _std_table(climate, city, w_length):
+    return std_data(climate, city, w_length)
+
+
+def _density_table(climate, city, w_length):
+    return density_data(climate, city, climate.get_years())
+
+
+TABLES = {
+    'calendar': _calendar_table,
+    'heat_map': _heat_map_table,
+    'yearly': _yearly_table,
+    'period': _period_table,
+    'std': _std_table,
+    'density': _density_table,
+}
+
+
+def table(climate, kind, cities=None, w_length=5):
+    """
+    Get the data of a kind of plot for several cities as a single tidy data
+    frame, with a CITY column.
+
+    Args:
+        climate: a climate object.
+        kind: the kind of plot, one of TABLES (str).
+        cities: list of city names, all of them by default.
+        w_length: window length in years of the moving averages (int).
+
+    Returns:
+        a data frame.
+    """
+    cities = climate.get_cities() if cities is None else cities
+    frames = []
+    for city in cities:
+        df = TABLES[kind](climate, city, w_length)
+        df.insert(0, 'CITY', city)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def export(climate, folder, kinds=None, cities=None, fmt='npz', w_length=5):
+    """
+    Write the data of the plots to folder, one file per kind of plot (see
+    table), without creating any figure.
+
+    Args:
+        climate: a climate object.
+        folder: the destination folder (str).
+        kinds: list of kinds of plots, all of TABLES by default.
+        cities: list of city names, all of them by default.
+        fmt: 'npz' (one array per column) or 'parquet' (needs pyarrow or
+            fastparquet) (str).
+        w_length: window length in years of the moving averages (int).
+
+    Returns:
+        the list of the written files.
+    """
+    assert fmt in ('npz', 'parquet'), "provided format is not available"
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for kind in kinds or TABLES:
+        df = table(climate, kind, cities, w_length)
+        path = os.path.join(folder, kind + '.' + fmt)
+        if fmt == 'npz':
+            df = df.infer_objects()
+            np.savez_compressed(path, **{
+                str(col): df[col].to_numpy(
+                    str if pd.api.types.is_string_dtype(df[col]) else None)
+                for col in df.columns})
+        else:
+            df.to_parquet(path, index=False)
+        paths.append(path)
+    return paths
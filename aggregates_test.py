@@ -0,0 +1,121 @@
+"""
+Tests of the aggregations behind the plots.
+"""
+
+import unittest
+import calendar
+import os
+import numpy as np
+import pandas as pd
+import shutil
+import tempfile
+import main
+import aggregates
+from main_test import write_sample_csv
+
+
+class TestAggregates(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_yearly_stats(self):
+		stats = aggregates.yearly_stats(self.climate, 'BOSTON', percentiles=[50])
+		temps = self.climate.filter_by(cities=['BOSTON'])
+		expected = temps.groupby(temps.index.year).agg(['min', 'max', 'mean', 'std', 'median'])
+		self.assertListEqual(list(stats.index), [2014, 2015])
+		np.testing.assert_allclose(stats[['min', 'max', 'mean', 'std', 'p50']].values, expected.values)
+
+	def test_std_data(self):
+		df = aggregates.std_data(self.climate, ['BOSTON', 'MIAMI'], w_length=2)
+		temps = self.climate.filter_by(cities=['BOSTON', 'MIAMI'])
+		y = temps.groupby(temps.index.year).agg(['min', 'max'])
+		np.testing.assert_allclose(df.MIN, main.moving_average(y['min'].values, 2))
+		np.testing.assert_allclose(df.Delta, df.MAX - df.MIN)
+
+	def test_period_data(self):
+		df = aggregates.period_data(self.climate, ['BOSTON', 'MIAMI'], days=[1, 2], months=1, years=[2015])
+		temps = self.climate.filter_by(cities=['BOSTON', 'MIAMI'], days=[1, 2], months=[1])
+		pd.testing.assert_series_equal(df.YEAR, pd.Series([2015], name='YEAR'))
+		self.assertAlmostEqual(df.TEMP[0], temps.mean())
+
+	def test_heat_map_data(self):
+		df = aggregates.heat_map_data(self.climate, 'MIAMI')
+		temps = self.climate.filter_by(cities=['MIAMI'])
+		self.assertListEqual(list(df.index), ['Dec', 'Nov', 'Oct', 'Sep', 'Aug', 'Jul', 'Jun', 'May', 'Apr', 'Mar', 'Feb', 'Jan'])
+		self.assertListEqual(list(df.columns), [2014, 2015])
+		self.assertAlmostEqual(df.loc['Jan', 2015], temps['2015-01'].mean())
+		self.assertAlmostEqual(df.loc['Dec', 2014], temps['2014-12'].mean())
+		self.assertTrue(np.isnan(df.loc['Jan', 2014]))
+
+		self.climate.append(pd.DataFrame({'CITY': ['MIAMI'], 'DATE': [20150111], 'TEMP': [100.0]}))
+		df = aggregates.heat_map_data(self.climate, 'MIAMI')
+		self.assertAlmostEqual(df.loc['Jan', 2015], self.climate.filter_by(cities=['MIAMI'])['2015-01'].mean())
+
+	def test_calendar_matrices(self):
+		dates = pd.date_range('2015-01-01', '2016-12-31')
+		dates = dates[dates != '2016-03-01']  # a month without its first day
+		path = os.path.join(self.tmpdir, 'calendar.csv')
+		pd.DataFrame({'CITY': 'BOSTON', 'TEMP': np.arange(len(dates)) / 10,
+					  'DATE': dates.strftime('%Y%m%d').astype(int)}).to_csv(path, index=False)
+		climate = main.Climate(path, cache=False)
+		day_nums, day_vals = aggregates.calendar_matrices(climate, 'BOSTON', [2015, 2016])
+
+		temps = climate.filter_by(cities=['BOSTON'])
+		for i, year in enumerate([2015, 2016]):
+			for month in range(1, 13):
+				weeks = np.array(calendar.monthcalendar(year, month), dtype=float)
+				weeks[weeks == 0] = np.nan
+				expected = np.full((6, 7), np.nan)
+				expected[:len(weeks)] = weeks
+				values = np.full((6, 7), np.nan)
+				for row, col in zip(*np.nonzero(~np.isnan(expected))):
+					date = pd.Timestamp(year, month, int(expected[row, col]))
+					if date in temps.index:
+						values[row, col] = temps[date]
+					else:
+						expected[row, col] = np.nan
+				np.testing.assert_array_equal(day_nums[i, month - 1], expected)
+				np.testing.assert_array_equal(day_vals[i, month - 1], values)
+		# the days after a missing first day keep their places
+		self.assertTrue(np.isnan(day_nums[1, 2, 0, 1]))
+		self.assertEqual(day_nums[1, 2, 0, 2], 2)
+
+	def test_density_grid(self):
+		result = aggregates.density_grid(self.climate, ['BOSTON', 'MIAMI'], [2015])
+		grid = result['grid']
+		for i, city in enumerate(['BOSTON', 'MIAMI']):
+			x = self.climate.get_yearly_temp(city, 2015)
+			x = x[~np.isnan(x)]
+			h = .5 * x.std(ddof=1) * len(x) ** (-1 / 5)
+			expected = np.exp(-.5 * ((grid[:, None] - x) / h)**2).sum(axis=1) / (len(x) * h * np.sqrt(2 * np.pi))
+			np.testing.assert_allclose(result['density'][i, 0], expected, atol=1e-2 * expected.max())
+			self.assertEqual(result['count'][i, 0], len(x))
+		temps = self.climate.filter_by(years=[2015])
+		self.assertTupleEqual(result['range'], (temps.min(), temps.max()))
+		self.assertIs(aggregates.density_grid(self.climate, ['MIAMI', 'BOSTON'], 2015), result)
+		self.assertIs(aggregates.density_grid(self.climate, np.array(['BOSTON', 'MIAMI']), np.arange(2015, 2016)), result)
+
+		df = aggregates.density_data(self.climate, ['BOSTON', 'MIAMI'], [2015])
+		self.assertListEqual(list(df.columns), ['YEAR', 'TEMP', 'DENSITY'])
+		self.assertAlmostEqual(df.DENSITY.sum() * (grid[1] - grid[0]), 1, places=3)
+
+	def test_export(self):
+		paths = aggregates.export(self.climate, self.tmpdir, cities=['MIAMI'])
+		self.assertEqual(len(paths), len(aggregates.TABLES))
+		data = np.load(paths[list(aggregates.TABLES).index('calendar')])
+		temps = self.climate.filter_by(cities=['MIAMI'])
+		self.assertListEqual(sorted(data['TEMP']), sorted(temps.values))
+		self.assertTrue((data['CITY'] == 'MIAMI').all())
+
+		std = aggregates.table(self.climate, 'std', w_length=1)
+		self.assertListEqual(list(std.CITY), ['BOSTON', 'BOSTON', 'MIAMI', 'MIAMI'])
+		np.testing.assert_allclose(std.MAX[2:], aggregates.std_data(self.climate, 'MIAMI').MAX)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the climate analysis functions.
+
+Usage:
+    python benchmark.py [name ...] [--data data.csv] [--repeat 3]
+
+Each benchmark prints the best wall time of its variants, so the speed-up
+of an optimised function can be compared against the implementation it
+replaced.
+"""
+
+import argparse
+import calendar
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import aggregates
+import main
+import trends
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    Register func as a benchmark. It receives the Climate instance and
+    returns a dict mapping each variant name to a callable without args.
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def best_time(func, repeat):
+    """
+    Get the best wall time in seconds of repeat calls to func.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def strftime_cities_avg(climate, multi_cities, years):
+    # gen_cities_avg before the integer year keys.
+    df = climate.filter_by(cities=multi_cities, years=years)
+    return df.groupby('{:%Y}'.format).mean().values
+
+
+def strftime_std_devs(climate, multi_cities, years):
+    # gen_std_devs before the integer year keys.
+    to_date = calendar.datetime.datetime.strptime
+    df = climate.filter_by(cities=multi_cities, years=years)
+    df = df.groupby('{:%Y-%m-%d}'.format).mean()
+    df.index = df.index.map(lambda x: to_date(x, '%Y-%m-%d'))
+    return np.array([df[df.index.year == year].values.std() for year in years])
+
+
+@benchmark
+def cities_avg(climate):
+    cities, years = climate.get_cities(), climate.get_years()
+    return {
+        'strftime': lambda: strftime_cities_avg(climate, cities, years),
+        'gen_cities_avg': lambda: main.gen_cities_avg(climate, cities, years),
+    }
+
+
+@benchmark
+def std_devs(climate):
+    cities, years = climate.get_cities(), climate.get_years()
+    return {
+        'strftime': lambda: strftime_std_devs(climate, cities, years),
+        'gen_std_devs': lambda: main.gen_std_devs(climate, cities, years),
+    }
+
+
+def sliced_moving_average(y, window_length):
+    # moving_average before the cumulative sums.
+    n = window_length
+    init_sum = [sum(y[:i+1])/(i+1) for i in range(n-1)]
+    final_sum = [sum(y[i:i+n])/n for i in range(len(y)-n+1)]
+    return np.array(init_sum + final_sum)
+
+
+@benchmark
+def moving_avg(climate):
+    # One row of daily temperatures per city.
+    cube = main.ClimateCube.from_climate(climate, dtype=float)
+    temps = np.nan_to_num(cube.temps)
+    return {
+        'sliced, per city': lambda: [sliced_moving_average(y, 30) for y in temps],
+        'moving_average, 2-d': lambda: main.moving_average(temps, 30),
+    }
+
+
+def polyfit_models(x, ys, degs):
+    # Fitting and evaluating one series at a time with generate_models.
+    results = []
+    for y in ys:
+        for model in main.generate_models(x, y, degs):
+            estimated = np.polyval(model, x)
+            results.append((main.r_squared(y, estimated),
+                            main.rmse(y, estimated)))
+    return results
+
+
+@benchmark
+def fit_models(climate):
+    # Yearly mean of every city, resampled 50 times.
+    cube = main.ClimateCube.from_climate(climate, dtype=float)
+    x = cube.years.astype(float)
+    means = cube.yearly_mean()
+    rng = np.random.default_rng(0)
+    ys = np.vstack([means[:, rng.integers(0, len(x), len(x))] for _ in range(50)])
+    return {
+        'polyfit loop': lambda: polyfit_models(x, ys, [1, 2]),
+        'fit_models': lambda: main.fit_models(x, ys, [1, 2]),
+    }
+
+
+def masked_period_data(climate, cities, days, months, years, w_length=1):
+    # graph_by_period numbers before aggregates.period_data.
+    to_date = calendar.datetime.datetime.strptime
+    temps = climate.filter_by(cities=cities, days=days, months=months, years=years)
+    temps = temps.groupby('{:%Y-%m-%d}'.format).mean()
+    temps.index = temps.index.map(lambda x: to_date(x, '%Y-%m-%d'))
+    y = np.array([temps[temps.index.year == year].values.mean()
+                  for year in years])
+    return main.moving_average(y, w_length)
+
+
+def masked_std_data(climate, cities, w_length=1):
+    # graph_std numbers before aggregates.std_data.
+    years = climate.get_years()
+    temps = climate.filter_by(cities=cities)
+    y = np.array([temps[temps.index.year == year].values.min()
+                  for year in years])
+    z = np.array([temps[temps.index.year == year].values.max()
+                  for year in years])
+    return main.moving_average(np.vstack([y, z]), w_length)
+
+
+@benchmark
+def period_data(climate):
+    cities, years = climate.get_cities(), climate.get_years()
+    days, months = list(range(1, 32)), list(range(1, 13))
+    return {
+        'strftime + masks': lambda: masked_period_data(
+            climate, cities, days, months, years, 5),
+        'aggregates.period_data': lambda: aggregates.period_data(
+            climate, cities, days, months, years, 5),
+    }
+
+
+@benchmark
+def std_data(climate):
+    cities = climate.get_cities()
+    return {
+        'masks': lambda: masked_std_data(climate, cities, 5),
+        'aggregates.std_data': lambda: aggregates.std_data(climate, cities, 5),
+    }
+
+
+def direct_density(climate, cities, years, gridsize=200, bw_adjust=.5):
+    # Gaussian sums evaluated year by year, as seaborn.kdeplot did in
+    # graphdensity_bycity before aggregates.density_grid.
+    density = {}
+    for city in cities:
+        for year in years:
+            x = climate.get_yearly_temp(city, year)
+            x = x[~np.isnan(x)]
+            h = bw_adjust * x.std(ddof=1) * len(x) ** (-1 / 5)
+            grid = np.linspace(x.min() - 3 * h, x.max() + 3 * h, gridsize)
+            z = (grid[:, None] - x[None, :]) / h
+            density[city, year] = np.exp(-.5 * z**2).sum(axis=1) / (
+                len(x) * h * np.sqrt(2 * np.pi))
+    return density
+
+
+def uncached_density_grid(climate, cities, years):
+    climate._derived.clear()
+    return aggregates.density_grid(climate, cities, years)
+
+
+@benchmark
+def density(climate):
+    cities, years = climate.get_cities(), climate.get_years()
+    return {
+        'per year Gaussian sums': lambda: direct_density(climate, cities, years),
+        'aggregates.density_grid': lambda: uncached_density_grid(
+            climate, cities, years),
+    }
+
+
+def searched_daily_temp(climate, city, month, day, year):
+    # get_daily_temp before the lookup table: a binary search in the rows
+    # of the city and year.
+    date = np.datetime64(calendar.datetime.date(year, month, day))
+    start, stop = climate._slices([city], [year])[0]
+    dates = climate.df.index.values
+    i = start + np.searchsorted(dates[start:stop], date)
+    return climate.df['TEMP'].iat[i]
+
+
+@benchmark
+def daily_temp(climate):
+    df = climate.get_df()
+    rows = np.random.default_rng(0).integers(0, len(df), 10000)
+    cities, dates = df['CITY'].values[rows], df.index[rows]
+    queries = list(zip(cities, dates.month, dates.day, dates.year))
+    return {
+        'binary search': lambda: [searched_daily_temp(climate, *query)
+                                  for query in queries],
+        'get_daily_temp': lambda: [climate.get_daily_temp(*query)
+                                   for query in queries],
+        'get_daily_temps': lambda: climate.get_daily_temps(cities, dates.values),
+    }
+
+
+def polyfit_bootstrap(x, ys, n_boot, seed=0):
+    # One np.polyfit per series and resample.
+    rng = np.random.default_rng(seed)
+    slopes = np.empty((len(ys), n_boot))
+    for i, y in enumerate(ys):
+        for b in range(n_boot):
+            rows = rng.integers(0, len(x), len(x))
+            slopes[i, b] = np.polyfit(x[rows], y[rows], 1)[0]
+    return slopes
+
+
+@benchmark
+def bootstrap(climate):
+    cities, periods, years, means = trends.period_means(climate, periods=['year'])
+    x, ys = years.astype(float), means[:, 0]
+    return {
+        'polyfit loop': lambda: polyfit_bootstrap(x, ys, 200),
+        'trends.batch_slopes': lambda: trends.batch_slopes(
+            x, ys, trends.resample_indices(len(x), 200, rng=0)),
+    }
+
+
+def polyfit_trends(climate, degs):
+    # One np.polyfit per city, period, statistic and degree.
+    cities, periods, stats, years, values = trends.period_stats(climate)
+    slopes = []
+    for series in values.reshape(-1, len(years)):
+        valid = ~np.isnan(series)
+        for deg in degs:
+            slopes.append(np.polyfit(years[valid], series[valid], deg)[-2])
+    return slopes
+
+
+@benchmark
+def trend_table(climate):
+    return {
+        'polyfit loop': lambda: polyfit_trends(climate, [1, 2]),
+        'trends.trend_table': lambda: trends.trend_table(climate),
+    }
+
+
+def refit_backtest(x, y, degs, windows, horizon=1, min_train=10):
+    # A fresh np.polyfit per split, degree and window.
+    errors = {}
+    for window in windows:
+        smoothed = main.moving_average(y, window)
+        for deg in degs:
+            for origin in range(min_train, len(x) - horizon + 1):
+                tested = slice(origin, origin + horizon)
+                model = np.polyfit(x[:origin], smoothed[:origin], deg)
+                errors[window, deg, origin] = smoothed[tested] - np.polyval(model, x[tested])
+    return errors
+
+
+@benchmark
+def backtest(climate):
+    years = np.array(climate.get_years())
+    y = main.gen_cities_avg(climate, climate.get_cities(), years)
+    return {
+        'polyfit per split': lambda: refit_backtest(years, y, [1, 2, 3], [1, 5, 10]),
+        'trends.backtest': lambda: trends.backtest(
+            years, y, [1, 2, 3], [1, 5, 10], schemes=['expanding']),
+    }
+
+
+def import_time(module):
+    # Start a fresh interpreter that only imports module.
+    subprocess.run([sys.executable, '-c', 'import ' + module], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+@benchmark
+def startup(climate):
+    variants = {'python': lambda: subprocess.run([sys.executable, '-c', ''])}
+    for module in ['main', 'aggregates', 'cli', 'graphics']:
+        variants['import ' + module] = lambda module=module: import_time(module)
+    return variants
+
+
+def run(names, filename, repeat):
+    climate = main.Climate(filename)
+    for name in names:
+        print(name)
+        for variant, func in BENCHMARKS[name](climate).items():
+            print('    {:<30} {:10.4f} s'.format(variant, best_time(func, repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run: %s (default: all)'
+                        % ', '.join(BENCHMARKS))
+    parser.add_argument('--data', default='data.csv', help='csv file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    run(args.names or list(BENCHMARKS), args.data, args.repeat)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface of the climate warming analysis.
+
+Usage:
+    python cli.py render KIND [--cities ...] [--years ...] [--processes N]
+    python cli.py fit [--degrees 1 2] [--window 5] [--train 1961 2009]
+    python cli.py fit --cv [--windows 1 5 10] [--horizon 1]
+    python cli.py trends [--periods ...] [--stats ...] [--degrees 1 2] [--out FILE]
+    python cli.py export [--kinds ...] [--format npz] [--out data_export]
+
+Only the modules a command needs are imported: render loads the plotting
+libraries, fit and export never do.
+"""
+
+import argparse
+import os
+import sys
+
+
+RENDER_KINDS = ['calendar', 'heat_map', 'yearly', 'period', 'std', 'density']
+
+
+def render(climate, args):
+    """
+    Render the plots of the given kind for the selected cities.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import graphics
+
+    cities = args.cities or climate.get_cities()
+    years = args.years or climate.get_years()
+    if args.kind in ('calendar', 'yearly'):
+        timings = graphics.render_books(args.kind, args.data, cities, years,
+                                        processes=args.processes, force=args.force)
+        for city, year, seconds in timings:
+            print('{} {}: {:.2f} s'.format(city, year, seconds))
+        return
+
+    if args.kind == 'heat_map':
+        graphics.heat_maps(climate, cities)
+        return
+
+    for city in cities:
+        if args.kind == 'density':
+            os.makedirs('densities plot', exist_ok=True)
+            graphics.graphdensity_bycity(climate, city, years,
+                                         path=os.path.join('densities plot', city + '.pdf'))
+        else:
+            if args.kind == 'period':
+                folder = 'mean_temperatures'
+                graphics.graph_by_period(climate, city, list(range(1, 32)),
+                                         list(range(1, 13)), years,
+                                         w_length=args.window, title=city)
+            else:
+                folder = 'std_plots'
+                graphics.graph_std(climate, [city], w_length=args.window)
+            os.makedirs(folder, exist_ok=True)
+            plt.savefig(os.path.join(folder, city + '.pdf'), bbox_inches='tight')
+            plt.close('all')
+        print(city)
+
+
+def fit(climate, args):
+    """
+    Fit the national yearly mean temperature (Part A/B of main.py) and
+    print the metrics of each degree on the training and testing years, or
+    cross-validate the degrees and windows on every split of the years.
+    """
+    import numpy as np
+    import pandas as pd
+    import main
+
+    cities = args.cities or climate.get_cities()
+    if args.cv:
+        import trends
+        years = np.arange(args.train[0], args.test[1] + 1)
+        y = main.gen_cities_avg(climate, cities, years)
+        print(trends.backtest(years, y, args.degrees, args.windows, args.horizon,
+                              processes=None).to_string(index=False))
+        return
+
+    train = np.arange(args.train[0], args.train[1] + 1)
+    test = np.arange(args.test[0], args.test[1] + 1)
+    y_train = main.moving_average(main.gen_cities_avg(climate, cities, train), args.window)
+    y_test = main.moving_average(main.gen_cities_avg(climate, cities, test), args.window)
+
+    rows = []
+    for deg, model in zip(args.degrees, main.fit_models(train, y_train, args.degrees)):
+        estimated = np.polyval(model['coefficients'][0], test)
+        rows.append({'degree': deg,
+                     'r_squared': model['r_squared'][0],
+                     'se_over_slope': model['se_over_slope'][0],
+                     'rmse_train': model['rmse'][0],
+                     'rmse_test': main.rmse(y_test, estimated)})
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+def trend_table(climate, args):
+    """
+    Fit the trends of every city, period and statistic, and print them or
+    write them as a csv file.
+    """
+    import trends
+
+    table = trends.trend_table(climate, args.cities, args.periods, args.stats,
+                               args.degrees)
+    if args.out:
+        table.to_csv(args.out, index=False)
+        print(args.out)
+    else:
+        print(table.to_string(index=False))
+
+
+def export(climate, args):
+    """
+    Write the data of the plots without creating any figure.
+    """
+    import aggregates
+
+    for path in aggregates.export(climate, args.out, args.kinds, args.cities,
+                                  fmt=args.format, w_length=args.window):
+        print(path)
+
+
+def parse_args(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data', default='data.csv', help='csv file')
+    common.add_argument('--cities', nargs='+', help='cities (default: all)')
+    common.add_argument('--window', type=int, default=5,
+                        help='moving average window in years')
+
+    parser = argparse.ArgumentParser(prog='climate-warming',
+                                     description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('render', parents=[common],
+                            help='render the plots as pdf files')
+    p.add_argument('kind', choices=RENDER_KINDS)
+    p.add_argument('--years', nargs='+', type=int, help='years (default: all)')
+    p.add_argument('--processes', type=int,
+                   help='render processes of the calendar and yearly plots')
+    p.add_argument('--force', action='store_true',
+                   help='render the calendar and yearly plots that are up to date too')
+    p.set_defaults(func=render)
+
+    p = commands.add_parser('fit', parents=[common],
+                            help='fit the national temperature trend')
+    p.add_argument('--degrees', nargs='+', type=int, default=[1, 2])
+    p.add_argument('--train', nargs=2, type=int, default=[1961, 2009],
+                   metavar=('FIRST', 'LAST'))
+    p.add_argument('--test', nargs=2, type=int, default=[2010, 2015],
+                   metavar=('FIRST', 'LAST'))
+    p.add_argument('--cv', action='store_true',
+                   help='backtest on every split of the training and testing years')
+    p.add_argument('--windows', nargs='+', type=int, default=[1, 5, 10],
+                   help='moving average windows of the backtest')
+    p.add_argument('--horizon', type=int, default=1,
+                   help='years tested after each split of the backtest')
+    p.set_defaults(func=fit)
+
+    p = commands.add_parser('trends', parents=[common],
+                            help='fit the trends of every city, period and statistic')
+    p.add_argument('--periods', nargs='+',
+                   help='year, Jan ... Dec, DJF, MAM, JJA or SON (default: all)')
+    p.add_argument('--stats', nargs='+', default=['mean', 'min', 'max', 'std'],
+                   choices=['mean', 'min', 'max', 'std'])
+    p.add_argument('--degrees', nargs='+', type=int, default=[1, 2])
+    p.add_argument('--out', help='csv file (default: print the table)')
+    p.set_defaults(func=trend_table)
+
+    p = commands.add_parser('export', parents=[common],
+                            help='export the data of the plots')
+    p.add_argument('--kinds', nargs='+', help='kinds of plots (default: all)')
+    p.add_argument('--format', choices=['npz', 'parquet'], default='npz')
+    p.add_argument('--out', default='data_export', help='destination folder')
+    p.set_defaults(func=export)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import main as climate_main
+    climate = climate_main.Climate(args.data)
+    args.func(climate, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
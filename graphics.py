@@ -8,15 +8,13 @@ Created on Tue Apr  6 11:09:09 2021
 # Collaborators: Karina Canziani.
 
 import main
+import aggregates
+from aggregates import calendar_matrices
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-import matplotlib.dates as mdates
-import matplotlib.ticker as ticker
-import seaborn as sns
-import calendar
 import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 weeks = [1, 2, 3, 4, 5, 6]
@@ -27,133 +25,350 @@ month_names = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
 
 def split_months(climate, city, year):
     """
-    Take a df, slice by year, and produce a list of months,
-    where each month is a 2D array in the shape of the calendar
-    :param df: dataframe or series
-    :return: matrix for daily values and numerals
+    Take the temperatures of a city, slice by year, and produce a list of
+    months, where each month is a 2D array in the shape of the calendar
+    (see calendar_matrices).
+    :param climate: climate object
+    :param city: city name in capital letters (str)
+    :param year: the year (int)
+    :return: matrix for daily values and numerals, as dicts by month (1-12)
     """
-    df = climate.get_df()
-    df = df[(df.index.year == year) & (df.CITY == city)]
+    day_nums, day_vals = calendar_matrices(climate, city, [year])
+    return ({m: day_nums[0, m-1] for m in range(1, 13)},
+            {m: day_vals[0, m-1] for m in range(1, 13)})
 
-    # Empty matrices
-    a = np.empty((6, 7))
-    a[:] = np.nan
 
-    day_nums = {m: np.copy(a) for m in range(1, 13)}  # matrix for day numbers
-    day_vals = {m: np.copy(a) for m in range(1, 13)}  # matrix for day values
-
-    # Logic to shape datetimes to matrices in calendar layout
-    for d in df.index:
-
-        day = d.day
-        month = d.month
-        year = d.year
-        col = d.dayofweek
-
-        if d.is_month_start:
-            row = 0
-
-        day_nums[month][row, col] = day  # day number (0-31)
-        day_vals[month][row, col] = df.loc[d].TEMP # day value (the heatmap data)
-
-        if col == 6:
-            row += 1
+class CalendarTemplate(object):
+    """
+    The figure of create_year_calendar. The axes, images, day labels and
+    patches of the 12 months are allocated once, and update only changes
+    the image arrays, the labels text and the patches visibility, so that
+    many calendars can be rendered with a single figure.
 
-    return day_nums, day_vals
+    The constrained layout is computed when the first calendar is saved and
+    then frozen, since the layout of the later calendars is the same.
+    """
 
+    def __init__(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import Normalize
+        from matplotlib.patches import Polygon
+        self.fig, ax = plt.subplots(3, 4, figsize=(14.85, 10.5),
+                                    constrained_layout=True)
+        self.norm = Normalize()
+        self.images, self.values, self.numbers, self.patches = [], [], [], []
+        blank = np.full((len(weeks), len(days)), np.nan)
+
+        for i, axs in enumerate(ax.flat):
+            # heatmap
+            im = axs.imshow(blank, cmap='jet', norm=self.norm)
+            axs.set_title(month_names[i])
+            self.images.append(im)
+
+            # Labels
+            axs.set_xticks(np.arange(len(days)))
+            axs.set_xticklabels(days, fontsize=10, fontweight='bold', color='#555555')
+            axs.set_yticklabels([])
+
+            # Tick marks
+            axs.tick_params(axis=u'both', which=u'both', length=0)
+            axs.xaxis.tick_top()
+
+            # Modify tick locations for proper grid placement
+            axs.set_xticks(np.arange(-.5, 6, 1), minor=True)
+            axs.set_yticks(np.arange(-.5, 5, 1), minor=True)
+            axs.grid(which='minor', color='w', linestyle='-', linewidth=2.1)
+
+            # Despine
+            for edge in ['left', 'right', 'bottom', 'top']:
+                axs.spines[edge].set_color('#FFFFFF')
+
+            # Annotate
+            values, numbers, patches = [], [], []
+            for w in range(len(weeks)):
+                for d in range(len(days)):
+                    # Value label
+                    values.append(axs.text(d, w+0.3, '', ha="center", va="center",
+                                           fontsize=7, color="w", alpha=0.8))
+
+                    # Grey patch, shown if the value is 0
+                    patch_coords = ((d - 0.5, w - 0.5),
+                                    (d - 0.5, w + 0.5),
+                                    (d + 0.5, w + 0.5),
+                                    (d + 0.5, w - 0.5))
+                    square = Polygon(patch_coords, fc='#DDDDDD', visible=False)
+                    patches.append(axs.add_artist(square))
+
+                    # Day number, shown if it is a valid calendar day
+                    numbers.append(axs.text(d+0.45, w-0.31, '', ha="right",
+                                            va="center", fontsize=6,
+                                            color="#003333", alpha=0.8))  # day
+
+                    # Aesthetic background for calendar day number
+                    patch_coords = ((d-0.1, w-0.5),
+                                    (d+0.5, w-0.5),
+                                    (d+0.5, w+0.1))
+
+                    triangle = Polygon(patch_coords, fc='w', alpha=0.7)
+                    axs.add_artist(triangle)
+            self.values.append(values)
+            self.numbers.append(numbers)
+            self.patches.append(patches)
+
+        # adding the color bar
+        cb = self.fig.colorbar(im, ax=ax[-1, 1:3], shrink=0.6, location='bottom')
+        cb.ax.set_xlabel(r'Temperature in °C', labelpad=-40, y=1.05)
+        self.title = self.fig.suptitle('', fontsize=16)
+        self.frozen = False
+
+    def update(self, day_nums, day_vals, city, year, limits):
+        """
+        Draw the calendar of a year.
+
+        Args:
+            day_nums: the (12 x 6 x 7) day numbers matrices of the year.
+            day_vals: the (12 x 6 x 7) day values matrices of the year.
+            city: city name in capital letters (str).
+            year: the year (int).
+            limits: (min, max) temperatures of the color scale.
+        """
+        self.norm.vmin, self.norm.vmax = limits
+        for i, im in enumerate(self.images):
+            im.set_data(day_vals[i])
+            nums, vals = day_nums[i].ravel(), day_vals[i].ravel()
+            for text, val in zip(self.values[i], vals):
+                text.set_text('' if np.isnan(val) else f"{val:0.0f}")
+            for text, num in zip(self.numbers[i], nums):
+                text.set_text('' if np.isnan(num) else f"{num:0.0f}")
+            for patch, val in zip(self.patches[i], vals):
+                patch.set_visible(val == 0)
+        self.title.set_text(r'$\bf{' + city + '}$' +'\n- '+str(year)+' -')
+
+    def save(self, path):
+        """
+        Save the calendar to a file, in the format of its extension, or as
+        a page of a PdfPages document.
+        """
+        from matplotlib.backends.backend_pdf import PdfPages
+        if isinstance(path, PdfPages):
+            path.savefig(self.fig)
+        else:
+            self.fig.savefig(path)
+        if not self.frozen:
+            self.fig.set_layout_engine('none')
+            self.frozen = True
+
+    def close(self):
+        import matplotlib.pyplot as plt
+        plt.close(self.fig)
+
+
+def create_year_calendar(climate, city, year, limits=None, path=None,
+                         matrices=None, data_only=False, template=None):
+    """
+    Plot the daily temperatures of the given city and year as a calendar
+    heatmap, and save it as a pdf file.
 
-def create_year_calendar(climate, city, year):
-    day_nums, day_vals = split_months(climate, city, year)
-    temps = climate.filter_by(cities=[city]).values
-    h_min, h_max = min(temps), max(temps) # min and max temp in historical data
-    fig, ax = plt.subplots(3, 4, figsize=(14.85, 10.5), constrained_layout=True)
+    Args:
+        climate: climate object.
+        city: city name in capital letters (str).
+        year: the year to plot (int).
+        limits: (min, max) temperatures of the color scale. By default, the
+            historical min and max temperatures of the city.
+        path: name of the pdf file, or a PdfPages document to add the page
+            to. By default, calendar_plots/CITY/CITYYEAR.pdf
+        matrices: the (12 x 6 x 7) day numbers and values matrices of the
+            year (see calendar_matrices). By default, they are computed.
+        data_only: return the (day_nums, day_vals) dicts of month matrices
+            (see split_months) without plotting them (bool).
+        template: a CalendarTemplate to draw the calendar with. By default,
+            a new one is created and closed once saved.
+    """
+    if matrices is None:
+        day_nums, day_vals = split_months(climate, city, year)
+    else:
+        day_nums = dict(enumerate(matrices[0], 1))
+        day_vals = dict(enumerate(matrices[1], 1))
+    if data_only:
+        return day_nums, day_vals
+    if limits is None:
+        history = climate.climatology(city)
+        limits = np.nanmin(history['min']), np.nanmax(history['max'])
+
+    calendar_figure = template or CalendarTemplate()
+    calendar_figure.update([day_nums[m] for m in range(1, 13)],
+                           [day_vals[m] for m in range(1, 13)], city, year, limits)
 
-    for i, axs in enumerate(ax.flat):
-        # heatmap
-        im = axs.imshow(day_vals[i+1], cmap='jet', vmin=h_min, vmax=h_max)
-        axs.set_title(month_names[i])
+    # Save to file
+    if path is None:
+        path = os.path.join('calendar_plots', city, city + str(year) + '.pdf')
+    calendar_figure.save(path)
+    if template is None:
+        calendar_figure.close()
 
-        # Labels
-        axs.set_xticks(np.arange(len(days)))
-        axs.set_xticklabels(days, fontsize=10, fontweight='bold', color='#555555')
-        axs.set_yticklabels([])
 
-        # Tick marks
-        axs.tick_params(axis=u'both', which=u'both', length=0)
-        axs.xaxis.tick_top()
+_worker_climate = None
 
-        # Modify tick locations for proper grid placement
-        axs.set_xticks(np.arange(-.5, 6, 1), minor=True)
-        axs.set_yticks(np.arange(-.5, 5, 1), minor=True)
-        axs.grid(which='minor', color='w', linestyle='-', linewidth=2.1)
 
-        # Despine
-        for edge in ['left', 'right', 'bottom', 'top']:
-            axs.spines[edge].set_color('#FFFFFF')
+def _init_worker(filename):
+    """
+    Load the climate of a rendering process, with a non-interactive backend.
+    """
+    import matplotlib.pyplot as plt
+    global _worker_climate
+    plt.switch_backend('Agg')
+    _worker_climate = main.Climate(filename)
 
-        # Annotate
-        for w in range(len(weeks)):
-            for d in range(len(days)):
-                day_val = day_vals[i+1][w, d]
-                day_num = day_nums[i+1][w, d]
 
-                # Value label
-                axs.text(d, w+0.3, f"{day_val:0.0f}",
-                         ha="center", va="center",
-                         fontsize=7, color="w", alpha=0.8)
+def _render_book(job):
+    """
+    Render the pages of every year of a city into a single pdf file, and
+    return the render time of each page. The file is written under a
+    temporary name and renamed once complete.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+    kind, city, years, path = job
+    climate = _worker_climate
+    timings = []
+    with PdfPages(path + '.part') as pages:
+        if kind == 'calendar':
+            history = climate.climatology(city)
+            limits = np.nanmin(history['min']), np.nanmax(history['max'])
+            day_nums, day_vals = calendar_matrices(climate, city, years)
+            template = CalendarTemplate()
+        else:
+            figure = YearlyFigure()
+        for i, year in enumerate(years):
+            start = time.perf_counter()
+            if kind == 'calendar':
+                create_year_calendar(climate, city, year, limits=limits,
+                                     path=pages, matrices=(day_nums[i], day_vals[i]),
+                                     template=template)
+            else:
+                figure.update(aggregates.yearly_data(climate, city, year), city, year)
+                pages.savefig(figure.fig, bbox_inches='tight')
+            timings.append((city, year, time.perf_counter() - start))
+        if kind == 'calendar':
+            template.close()
+        else:
+            plt.close(figure.fig)
+    os.replace(path + '.part', path)
+    with open(path + '.years', 'w') as sidecar:
+        sidecar.write(' '.join(map(str, years)))
+    return timings
+
+
+def book_years(path):
+    """
+    Read the years rendered into a pdf book from its sidecar file,
+    path + '.years', written once the book is complete.
 
-                # If value is 0, draw a grey patch
-                if day_val == 0:
-                    patch_coords = ((d - 0.5, w - 0.5),
-                                    (d - 0.5, w + 0.5),
-                                    (d + 0.5, w + 0.5),
-                                    (d + 0.5, w - 0.5))
+    Args:
+        path: path of the pdf book (str).
 
-                    square = Polygon(patch_coords, fc='#DDDDDD')
-                    axs.add_artist(square)
+    Returns:
+        the list of years (int), or None if the book has no sidecar file.
+    """
+    try:
+        with open(path + '.years') as sidecar:
+            return [int(year) for year in sidecar.read().split()]
+    except FileNotFoundError:
+        return None
 
-                # If day number is a valid calendar day, add an annotation
-                if not np.isnan(day_num):
-                    axs.text(d+0.45, w-0.31, f"{day_num:0.0f}",
-                             ha="right", va="center",
-                             fontsize=6, color="#003333", alpha=0.8)  # day
 
-                # Aesthetic background for calendar day number
-                patch_coords = ((d-0.1, w-0.5),
-                                (d+0.5, w-0.5),
-                                (d+0.5, w+0.1))
+def book_jobs(kind, filename, cities, years, folder, force=False):
+    """
+    List the pdf books to render: one per city, folder/CITY.pdf. A book is
+    skipped when it is newer than the csv file and than this module and
+    holds the same years, unless force is True.
 
-                triangle = Polygon(patch_coords, fc='w', alpha=0.7)
-                axs.add_artist(triangle)
+    Args:
+        kind: 'calendar' or 'yearly' (str).
+        filename: name of the csv file (str)
+        cities: list of city names.
+        years: list of years (int).
+        folder: folder of the pdf files (str).
+        force: render the books even if they are up to date (bool).
+
+    Returns:
+        a list of (kind, city, years, path) tuples.
+    """
+    updated = max(os.path.getmtime(filename), os.path.getmtime(__file__))
+    years = [int(year) for year in years]
+    jobs = []
+    for city in cities:
+        path = os.path.join(folder, city + '.pdf')
+        if (force or not os.path.exists(path) or
+                os.path.getmtime(path) < updated or book_years(path) != years):
+            jobs.append((kind, city, years, path))
+    return jobs
+
+
+def render_books(kind, filename='data.csv', cities=None, years=None,
+                 folder=None, processes=None, force=False):
+    """
+    Render the calendars (see create_year_calendar) or the yearly graphs (see
+    graph_by_year) of the given years straight into one multi-page pdf per
+    city, folder/CITY.pdf, spreading the cities over a pool of processes.
+    The pdf files that are up to date are skipped (see book_jobs).
 
-    # adding the color bar
-    cb = fig.colorbar(im, ax=ax[-1, 1:3], shrink=0.6, location='bottom')
-    cb.ax.set_xlabel(r'Temperature in °C', labelpad=-40, y=1.05)
+    Args:
+        kind: 'calendar' or 'yearly' (str).
+        filename: name of the csv file (str)
+        cities: list of city names, all of them by default.
+        years: list of years (int), all of them by default.
+        folder: folder where the pdf files are saved (str). By default,
+            calendar_plots or yearly_temp_plots.
+        processes: number of processes, the number of CPUs by default.
+        force: render the pdf files even if they are up to date (bool).
+
+    Returns:
+        a list of (city, year, seconds) tuples with the render time of each
+        rendered page.
+    """
+    assert kind in ('calendar', 'yearly'), "provided kind is not available"
+    climate = main.Climate(filename)
+    cities = climate.get_cities() if cities is None else cities
+    years = climate.get_years() if years is None else years
+    folder = folder or {'calendar': 'calendar_plots',
+                        'yearly': 'yearly_temp_plots'}[kind]
+    os.makedirs(folder, exist_ok=True)
+    jobs = book_jobs(kind, filename, cities, years, folder, force)
+
+    timings = []
+    with ProcessPoolExecutor(processes, initializer=_init_worker,
+                             initargs=(filename,)) as pool:
+        for pages in pool.map(_render_book, jobs):
+            timings.extend(pages)
+    return timings
+
+
+def render_calendars(filename='data.csv', cities=None, years=None,
+                     folder='calendar_plots', processes=None, force=False):
+    """
+    Render the calendar of every given city and year into one multi-page pdf
+    per city, folder/CITY.pdf (see render_books).
+    """
+    return render_books('calendar', filename, cities, years, folder,
+                        processes, force)
 
-    # Final adjustments
-    fig.suptitle(r'$\bf{' + city + '}$' +'\n- '+str(year)+' -', fontsize=16)
-    # plt.subplots_adjust(left=0.04, right=0.96, top=0.88, bottom=0.04)
 
-    # Save to file
-    plt.savefig('calendar_plots\\'+city+'\\'+city+str(year)+'.pdf')
-    plt.clf()
+def render_yearly(filename='data.csv', cities=None, years=None,
+                  folder='yearly_temp_plots', processes=None, force=False):
+    """
+    Render the yearly graph of every given city and year into one multi-page
+    pdf per city, folder/CITY.pdf (see render_books).
+    """
+    return render_books('yearly', filename, cities, years, folder,
+                        processes, force)
 
 # =============================================================================
-# import os
-# climate = main.Climate('data.csv')
-# YEARS = climate.get_years()
-# CITIES = climate.get_cities()
-#
-# for city in CITIES:
-#     path = os.path.join('calendar_plots\\', city)
-#     os.mkdir(path)
-#
-#     for year in YEARS:
-#         create_year_calendar(climate, city, year)
+# render_calendars('data.csv')
 # =============================================================================
 
 
-def heat_map(climate, city):
+def heat_map(climate, city, data_only=False, path=None, cube=None):
     """
     Graph the monthly mean temperature for a given city as function of the
     years.
@@ -161,35 +376,59 @@ def heat_map(climate, city):
     Args:
         climate: climate object.
         city: city name in capital letters (str).
+        data_only: return the data of the plot (see
+            aggregates.heat_map_data) without plotting it (bool).
+        path: name of the pdf file. By default, heatmaps/CITY.pdf
+        cube: monthly means of several cities (see aggregates.heat_map_cube).
+            By default, they are computed for city alone.
 
     Retunrs:
         A seaborn heatmap plot of the mean monthly temperature for each month
     for each year in the climate object.
 
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    df = aggregates.heat_map_data(climate, city, cube)
+    if data_only:
+        return df
+
     # Size set up
     plt.rcParams['figure.figsize'] = (80.0, 15.0)
     plt.rcParams['font.family'] = "serif"
 
-    # Prepearing the data frame.
-    df = climate.get_df()
-    mean_month = df.groupby(['YEAR','MONTH','CITY'])['TEMP'].agg(media='mean')
-    mean_month.reset_index(inplace=True)
-    df = mean_month[mean_month['CITY'] == city]
-    df = pd.pivot_table(df, index='MONTH', values='media', columns='YEAR')
-    lista = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Oct',
-             'Nov', 'Dec']
-    df = df.reindex(reversed(lista))
-
     # Plot configuration
     sns.set(font_scale=1.4)
     p = sns.heatmap(df, cmap='coolwarm', annot=True,
                     cbar_kws={"shrink": 0.8}, annot_kws={'size': 16})
     p.set_title(city, fontsize=50)
     fig = p.get_figure()
-    fig.savefig('heatmaps\\'+city+'.pdf', bbox_inches='tight', pad_inches=0.3)
+    if path is None:
+        path = os.path.join('heatmaps', city + '.pdf')
+    fig.savefig(path, bbox_inches='tight', pad_inches=0.3)
     fig.clf()
 
+def heat_maps(climate, cities=None, folder='heatmaps', data_only=False):
+    """
+    Graph the heat map of several cities (see heat_map) from the monthly
+    means of all of them, computed at once.
+
+    Args:
+        climate: climate object.
+        cities: list of city names, all of them by default.
+        folder: folder where the pdf files are saved (str).
+        data_only: return the data of the plots without plotting them (bool).
+
+    Returns:
+        if data_only, a dict with the data frame of each city.
+    """
+    cube = aggregates.heat_map_cube(climate, cities)
+    if data_only:
+        return {city: heat_map(climate, city, True, cube=cube) for city in cube[0]}
+    os.makedirs(folder, exist_ok=True)
+    for city in cube[0]:
+        heat_map(climate, city, path=os.path.join(folder, city + '.pdf'), cube=cube)
+
 # =============================================================================
 # CITIES = main.Climate('data.csv').get_cities()
 # climate = main.Climate('data.csv')
@@ -198,7 +437,7 @@ def heat_map(climate, city):
 # =============================================================================
 
 
-def graph_by_year(climate, city, year):
+def graph_by_year(climate, city, year, data_only=False, path=None):
     """
     Graph the temperature as a function of the days of the given climate, city
     and year. It also plots the historical mean temperature within one standar
@@ -209,60 +448,97 @@ def graph_by_year(climate, city, year):
         climate: climate object.
         city: city name in capital letters (str).
         year: the year to get the data for (int).
+        data_only: return the data of the plot (see aggregates.yearly_data)
+            without plotting it (bool).
+        path: name of the pdf file. By default,
+            yearly_temp_plots/CITY/CITYYEAR.pdf
 
     Retunrs:
         A seaborn lineplot of (14x6) inches of temperatures vs months.
 
     """
+    import matplotlib.pyplot as plt
 
-    temps = climate.filter_by(cities=[city])
-
-    t_min_max = temps.groupby('{:%m-%d}'.format)
-    t_min_max = t_min_max.agg(t_min='min', t_max='max', t_mean='mean', t_std='std')
+    df = aggregates.yearly_data(climate, city, year)
+    if data_only:
+        return df
 
-    if not calendar.isleap(year):
-        t_min_max = t_min_max.drop('02-29')
+    figure = YearlyFigure()
+    figure.update(df, city, year)
+    if path is None:
+        path = os.path.join('yearly_temp_plots', city, city + str(year) + '.pdf')
+    figure.fig.savefig(path, bbox_inches = 'tight')
+    plt.close(figure.fig)
 
-    temps = pd.DataFrame(temps[temps.index.year == year])
-    t_min_max.reset_index(inplace=True), temps.reset_index(inplace=True)
-    df = pd.concat([temps, t_min_max[['t_min', 't_max', 't_mean', 't_std']]],
-                   axis=1)
 
-    # Plot Labels
-    label1 = '$\mu_H$'
-    label2 = 'T'
-    label3 = '$max_H - min_H$'
-    label4 = '$\mu_H\pm\sigma_H$'
-    # Set up the plots
-    fig, ax = plt.subplots(figsize=(14, 6))
-    ax = sns.lineplot(x='DATE', y='t_mean', data=df, color='sandybrown',
-                      label=label1, linewidth=2.5)
-    ax = sns.lineplot(x='DATE', y='TEMP', data=df, linewidth=2, label=label2)
-    ax.fill_between(x='DATE', y1='t_max', y2='t_min', data=df, alpha=0.25,
-                    label=label3)
-    ax.fill_between(x=df.DATE, y1=(df.t_mean-df.t_std),
-                    y2=(df.t_mean+df.t_std), label=label4, alpha=0.18)
-
-    # Plot details
-    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),
-          fancybox=True, shadow=True, ncol=4)
-    ax.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
-    ax.xaxis.set_minor_locator(mdates.MonthLocator(bymonthday=16)) # 16 is a slight approximation since months differ in number of days.
-    ax.xaxis.set_major_formatter(ticker.NullFormatter())
-    ax.xaxis.set_minor_formatter(mdates.DateFormatter('%b'))
-    for tick in ax.xaxis.get_minor_ticks():
-        tick.tick1line.set_markersize(0)
-        tick.tick2line.set_markersize(0)
-        tick.label1.set_horizontalalignment('center')
-    ax.set_xlim(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
-    ax.set_xlabel(None)
-    ax.set_ylabel('Temperature (ºC)')
+class YearlyFigure(object):
+    """
+    The figure of graph_by_year. The axes, lines, legend and ticks are built
+    once, and update draws the data of another city or year in place, so
+    that many years can be rendered with a single figure.
+    """
 
-    ax.set_title('{} - {} - '.format(city, year))
-    ax.grid(axis='x', c='gray', ls='--')
-    path = 'yearly_temp_plots\\'+city+'\\'+city+str(year)+'.pdf'
-    plt.savefig(path, bbox_inches = 'tight')
-    fig.clf()
+    def __init__(self):
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        import matplotlib.ticker as ticker
+        # Plot Labels
+        label1 = '$\mu_H$'
+        label2 = 'T'
+        label3 = '$max_H - min_H$'
+        label4 = '$\mu_H\pm\sigma_H$'
+        # Set up the plots
+        self.fig, ax = plt.subplots(figsize=(14, 6))
+        self.ax = ax
+        self.mean_line, = ax.plot([], [], color='sandybrown', label=label1,
+                                  linewidth=2.5)
+        self.temp_line, = ax.plot([], [], color='C0', linewidth=2, label=label2)
+        self.fills = [ax.fill_between([], [], [], color='C0', alpha=0.25,
+                                      label=label3),
+                      ax.fill_between([], [], [], color='C1', alpha=0.18,
+                                      label=label4)]
+
+        # Plot details
+        ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),
+              fancybox=True, shadow=True, ncol=4)
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
+        ax.xaxis.set_minor_locator(mdates.MonthLocator(bymonthday=16)) # 16 is a slight approximation since months differ in number of days.
+        ax.xaxis.set_major_formatter(ticker.NullFormatter())
+        ax.xaxis.set_minor_formatter(mdates.DateFormatter('%b'))
+        for tick in ax.xaxis.get_minor_ticks():
+            tick.tick1line.set_markersize(0)
+            tick.tick2line.set_markersize(0)
+            tick.label1.set_horizontalalignment('center')
+        ax.set_xlabel(None)
+        ax.set_ylabel('Temperature (ºC)')
+        ax.grid(axis='x', c='gray', ls='--')
+
+    def update(self, df, city, year):
+        """
+        Draw the data of a year (see aggregates.yearly_data).
+
+        Args:
+            df: data frame with the columns DATE, TEMP, t_min, t_max, t_mean
+                and t_std.
+            city: city name in capital letters (str).
+            year: the year of the data (int).
+        """
+        import matplotlib.dates as mdates
+        ax = self.ax
+        x = mdates.date2num(df.DATE)
+        self.mean_line.set_data(x, df.t_mean)
+        self.temp_line.set_data(x, df.TEMP)
+        # The fills are the only artists rebuilt, their polygons depend on
+        # the data.
+        for fill in self.fills:
+            fill.remove()
+        ax.relim()
+        self.fills = [ax.fill_between(x, df.t_max, df.t_min, color='C0', alpha=0.25),
+                      ax.fill_between(x, df.t_mean - df.t_std, df.t_mean + df.t_std,
+                                      color='C1', alpha=0.18)]
+        ax.autoscale_view()
+        ax.set_xlim(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+        ax.set_title('{} - {} - '.format(city, year))
 
 
 # =============================================================================
@@ -278,7 +554,8 @@ def graph_by_year(climate, city, year):
 #         graph_by_year(climate, city, year)
 # =============================================================================
 
-def graph_by_period(climate, cities, days, months, years, w_length=1, title=''):
+def graph_by_period(climate, cities, days, months, years, w_length=1, title='',
+                    data_only=False):
     """
     Graph the average temperature as a function of the years of a list of
     cities, days and months.
@@ -295,35 +572,19 @@ def graph_by_period(climate, cities, days, months, years, w_length=1, title=''):
         months: int or list of ints the months
         w_length: compute the moving average of temperatures with
         specified window length of years.
+        data_only: return the data of the plot (see aggregates.period_data)
+            without plotting it (bool).
 
     Retunrs:
         A seaborn lineplot of (14x6) inches of temperatures vs years.
     """
-    # Handling different input types
-    if isinstance(cities, str):
-        cities = [cities]
-
-    if isinstance(days, int):
-        days = [days]
-
-    if isinstance(months, int):
-        months = [months]
-
-    # Filtering the data frame by cities, months, days
-    temps = climate.filter_by(cities=cities, days=days, months=months, years=years)
-
-    # Mean value of cities temperatures remaining constant every day and month.
-    temps = temps.groupby('{:%Y-%m-%d}'.format).mean()
-
-    # Mean value of the period temperatures remaining constant every year.
-    to_date = calendar.datetime.datetime.strptime
-    temps.index = temps.index.map(lambda x: to_date(x, '%Y-%m-%d'))
-    y = np.array([temps[temps.index.year == year].values.mean()
-                      for year in years])
-
-    # Computing the moving average and seting up the data frame.
-    y = main.moving_average(y, w_length)
-    df = pd.DataFrame({'YEAR': years, 'TEMP': y})
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import seaborn as sns
+    df = aggregates.period_data(climate, cities, days, months, years, w_length)
+    if data_only:
+        return df
+    y = df.TEMP
 
     # Minimal and Maximal temperatures after all the averages
     temp_min, temp_max = min(y)-0.2, max(y)+0.2
@@ -347,8 +608,8 @@ def graph_by_period(climate, cities, days, months, years, w_length=1, title=''):
     ax.grid(axis='x', c='gray', ls='--')
 
 
-climate = main.Climate('data.csv')
 # =============================================================================
+# climate = main.Climate('data.csv')
 # CITIES = climate.get_cities()
 # title = 'Mean Temperature Evolution in USA'
 # days = range(1,32)
@@ -374,7 +635,7 @@ climate = main.Climate('data.csv')
 
 
 
-def graph_std(climate, cities, w_length=1):
+def graph_std(climate, cities, w_length=1, data_only=False):
     """
     Plot the std for a given city across the years.
 
@@ -383,25 +644,18 @@ def graph_std(climate, cities, w_length=1):
         city: a str or list of str of cities names in capital letters.
         w_length: compute the moving average of temperatures with
         specified window length of years.
+        data_only: return the data of the plot (see aggregates.std_data)
+            without plotting it (bool).
 
     Retunrs:
         A seaborn lineplot of (14x6) inches of std temperatures vs years.
     """
-    years = climate.get_years()
-    # Filtering the data frame by cities, months, days
-    temps = climate.filter_by(cities=cities)
-
-    # std value of the period temperatures remaining constant every year.
-    y = np.array([temps[temps.index.year == year].values.min()
-                      for year in years])
-    z = np.array([temps[temps.index.year == year].values.max()
-                      for year in years])
-
-    # Computing the moving average and seting up the data frame.
-    y = main.moving_average(y, w_length)
-    z = main.moving_average(z, w_length)
-    w = z - y
-    df = pd.DataFrame({'YEAR': years, 'MIN': y, 'MAX': z, 'Delta': w})
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import seaborn as sns
+    df = aggregates.std_data(climate, cities, w_length)
+    if data_only:
+        return df
 
     # Minimal and Maximal temperatures after all the averages
     temp_min, temp_max =-30, 52
@@ -427,7 +681,7 @@ def graph_std(climate, cities, w_length=1):
 
 # graph_std(climate, ['SEATTLE'], w_length=5)
 
-def graphdensity_bycity(climate, city, years):
+def graphdensity_bycity(climate, city, years, data_only=False, path=None):
     """
     Density plot for a given city across the years.
 
@@ -435,10 +689,15 @@ def graphdensity_bycity(climate, city, years):
         climate: a climate object.
         city: a str or list of str of cities names in capital letters.
         years: list of years (int)
+        data_only: return the data of the plot (see aggregates.density_data)
+            without plotting it (bool).
+        path: name of the pdf file. By default, CITY.pdf
 
     Retunrs:
         A seaborn ridge plot of (14x6) inches of std temperatures vs years.
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     if isinstance(city, str):
         city = [city]
@@ -446,12 +705,11 @@ def graphdensity_bycity(climate, city, years):
     if isinstance(years, int):
         years = [years]
 
-    temps = climate.filter_by(cities=city, years=years)
-    y = temps.groupby('{:%Y-%m-%d}'.format).mean()
-    to_date = calendar.datetime.datetime.strptime
-    y.index = y.index.map(lambda x: to_date(x, '%Y-%m-%d'))
-    df = pd.DataFrame(temps)
-    df['YEAR'] = df.index.year
+    df = aggregates.density_data(climate, city, years)
+    if data_only:
+        return df
+    # The padded grid of the densities is wider than the temperatures.
+    t_min, t_max = aggregates.density_grid(climate, city, years)['range']
 
     # plot Set up
     sns.set_theme(style="white", rc={"axes.facecolor": (0, 0, 0, 0)})
@@ -461,10 +719,10 @@ def graphdensity_bycity(climate, city, years):
 
     g = sns.FacetGrid(df, row="YEAR", hue="YEAR", aspect=15, height=.5,
                       palette=pal)
-    # Draw the densities in a few steps
-    g.map(sns.kdeplot, "TEMP", bw_adjust=.5, clip_on=False, fill=True, alpha=1,
+    # Draw the precomputed densities in a few steps
+    g.map(plt.fill_between, "TEMP", "DENSITY", clip_on=False, alpha=1,
           linewidth=1.5)
-    g.map(sns.kdeplot, "TEMP", clip_on=False, color="w", lw=2, bw_adjust=.5)
+    g.map(plt.plot, "TEMP", "DENSITY", clip_on=False, color="w", lw=2)
     g.map(plt.axhline, y=0, lw=2, clip_on=False)
 
     # Define and use a simple function to label the plot in axes coordinates
@@ -481,13 +739,14 @@ def graphdensity_bycity(climate, city, years):
     g.set_titles("")
     g.set(yticks=[])
     g.despine(bottom=True, left=True)
-    t_min, t_max = min(df.TEMP), max(df.TEMP)
     g.set(yticks=[], xlim=[t_min, t_max])
-    g.set_xlabels('')
+    g.set_axis_labels('', '')
     g.fig.suptitle('Distribution of temperatures in ' + str(city[0]), size=14,
                    weight='bold', color='#45818e')
-    plt.savefig(str(city[0]) + '.pdf')
-    plt.clf()
+    if path is None:
+        path = str(city[0]) + '.pdf'
+    plt.savefig(path)
+    plt.close(g.fig)
 
 
 
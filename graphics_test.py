@@ -0,0 +1,71 @@
+"""
+Tests of the pdf books of plots.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import main
+import graphics
+from main_test import write_sample_csv
+
+
+class TestRenderBooks(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = write_sample_csv(self.tmpdir)
+		self.folder = os.path.join(self.tmpdir, 'books')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def render(self, years, force=False):
+		return graphics.render_yearly(self.path, cities=['MIAMI'], years=years,
+									  folder=self.folder, processes=1, force=force)
+
+	def test_render_yearly(self):
+		book = os.path.join(self.folder, 'MIAMI.pdf')
+		timings = self.render([2014])
+		self.assertListEqual([page[:2] for page in timings], [('MIAMI', 2014)])
+		self.assertTrue(os.path.getsize(book) > 0)
+		self.assertFalse(os.path.exists(book + '.part'), "temporary file was left")
+		self.assertListEqual(graphics.book_years(book), [2014])
+
+		# an up to date book is skipped, other years or force render it again
+		self.assertListEqual(self.render([2014]), [])
+		self.assertEqual(len(self.render([2014, 2015])), 2)
+		self.assertListEqual(graphics.book_years(book), [2014, 2015])
+		self.assertEqual(len(self.render([2014, 2015], force=True)), 2)
+
+	def test_render_calendar(self):
+		timings = graphics.render_calendars(self.path, cities=['BOSTON'], years=[2015],
+											folder=self.folder, processes=1)
+		self.assertListEqual([page[:2] for page in timings], [('BOSTON', 2015)])
+		with open(os.path.join(self.folder, 'BOSTON.pdf'), 'rb') as f:
+			self.assertEqual(f.read(4), b'%PDF')
+
+		# a single calendar is saved in the format of its extension
+		path = os.path.join(self.tmpdir, 'BOSTON2015.png')
+		graphics.create_year_calendar(main.Climate(self.path, cache=False), 'BOSTON', 2015, path=path)
+		with open(path, 'rb') as f:
+			self.assertEqual(f.read(4), b'\x89PNG')
+
+	def test_book_jobs(self):
+		os.makedirs(self.folder)
+		jobs = graphics.book_jobs('calendar', self.path, ['BOSTON', 'MIAMI'], [2014], self.folder)
+		self.assertEqual(len(jobs), 2)
+		book = os.path.join(self.folder, 'BOSTON.pdf')
+		open(book, 'w').close()
+		# a book without its years, or older than the csv file, is rendered
+		self.assertEqual(len(graphics.book_jobs('calendar', self.path, ['BOSTON'], [2014], self.folder)), 1)
+		with open(book + '.years', 'w') as sidecar:
+			sidecar.write('2014')
+		self.assertListEqual(graphics.book_jobs('calendar', self.path, ['BOSTON'], [2014], self.folder), [])
+		os.utime(book, (0, 0))
+		self.assertEqual(len(graphics.book_jobs('calendar', self.path, ['BOSTON'], [2014], self.folder)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
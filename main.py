@@ -11,39 +11,826 @@ Created on Fri Apr  9 19:24:08 2021
 # Goals: Prove global warning is not a scam
 
 import pandas as pd
+import bisect
 import calendar
+import hashlib
+import json
+import os
+import sys
+import warnings
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import seaborn as sns
 
 """
 Begin helper code
 """
+CACHE_VERSION = 2
+CLIMATOLOGY_CACHE_SIZE = 64
+BASELINE = (1961, 1990)
+
+
+def _read_csv(filename):
+    """
+    Read the csv file and parse its DATE column.
+
+    Args:
+        filename: name of the csv file (str)
+
+    Returns:
+        a data frame with the csv columns, DATE as datetime64.
+    """
+    df = pd.read_csv(filename)
+    df['DATE'] = pd.to_datetime(df['DATE'], format='%Y%m%d')
+    return df
+
+
+def _file_hash(filename):
+    """
+    Compute the sha1 hex digest of the given file, reading it in chunks.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_dir(filename):
+    """
+    Get the directory where the binary cache of the csv file is stored.
+
+    Args:
+        filename: name of the csv file (str)
+
+    Returns:
+        the path of the cache directory (str)
+    """
+    return filename + '.cache'
+
+
+def _write_cache(filename, arrays, meta):
+    """
+    Store the np arrays of the dict arrays as .npy files inside the cache
+    directory of filename, keyed on the size, modification time and sha1
+    hash of the file, with the json-serialisable dict meta. The meta.json
+    file is written last, so an interrupted write is never taken as a valid
+    cache.
+    """
+    stat = os.stat(filename)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+           'sha1': _file_hash(filename)}
+    directory = cache_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    for name, values in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), values)
+    meta = dict(meta, **key, version=CACHE_VERSION, arrays=list(arrays))
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def _read_cache(filename):
+    """
+    Get the arrays stored in the binary cache of filename (see _write_cache)
+    when it is still valid. The cache is valid while the size and the
+    modification time of the file are unchanged; when only the modification
+    time changed the file is hashed, and the cache is kept if the hash did
+    not change.
+
+    Args:
+        filename: name of the csv file (str)
+
+    Returns:
+        a tuple (arrays, meta) with the dict of the memory-mapped np arrays
+        and the meta dict, or None if there is no valid cache.
+    """
+    stat = os.stat(filename)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    directory = cache_dir(filename)
+    meta_path = os.path.join(directory, 'meta.json')
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or meta['size'] != key['size']:
+        return None
+    if meta['mtime_ns'] != key['mtime_ns']:
+        # The file was touched: check whether its content changed.
+        if meta['sha1'] != _file_hash(filename):
+            return None
+        meta.update(key)
+        try:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except OSError:
+            pass
+    try:
+        # Plain array views of the memory maps.
+        arrays = {name: np.asarray(np.load(os.path.join(directory, name + '.npy'),
+                                           mmap_mode='r'))
+                  for name in meta['arrays']}
+    except (OSError, ValueError):
+        return None
+    return arrays, meta
+
+
+def _year_bounds(year, offset):
+    """
+    Get the distinct years of the sorted array year and the bounds of their
+    records, shifted by offset (see Climate._build_index).
+    """
+    change = np.flatnonzero(year[1:] != year[:-1]) + 1
+    bounds = np.concatenate(([0], change, [len(year)]))
+    return year[bounds[:-1]], bounds + offset
+
+
+def _totals_index(offsets):
+    """
+    Get the (CITY, YEAR) index of the yearly totals of the offset table.
+    """
+    cities = sorted(offsets)
+    years = [offsets[city][0] for city in cities]
+    return pd.MultiIndex.from_arrays(
+        [np.repeat(cities, [len(y) for y in years]).astype(object),
+         np.concatenate(years) if years else np.array([], dtype=int)],
+        names=['CITY', 'YEAR'])
+
+
+def _yearly_totals(temps, offsets):
+    """
+    Get the count, sum and sum of squares of the temperatures by city and
+    year (see Climate.yearly_totals), reducing the rows of each year in
+    place from the offset table of the sorted records (see
+    Climate._build_index).
+    """
+    cities = sorted(offsets)
+    index = _totals_index(offsets)
+    if not cities:
+        return pd.DataFrame({'count': [], 'sum': [], 'sumsq': []}, index=index)
+    # The cities follow each other in the rows, so the starts of their years
+    # are increasing and each year is one group of the reduction.
+    starts = np.concatenate([offsets[city][1][:-1] for city in cities])
+    temps = np.asarray(temps, dtype=float)[starts[0]:]
+    starts = starts - starts[0]
+    valid = ~np.isnan(temps)
+    values = np.where(valid, temps, 0)
+    return pd.DataFrame({'count': np.add.reduceat(valid, starts),
+                         'sum': np.add.reduceat(values, starts),
+                         'sumsq': np.add.reduceat(values**2, starts)}, index=index)
+
+
+def day_of_year(dates):
+    """
+    Get the day of year (0-365) of dates in a leap year calendar, so each
+    calendar day keeps its position across the years (Feb 29 is 59).
+
+    Args:
+        dates: a pandas DatetimeIndex
+
+    Returns:
+        a np array of ints.
+    """
+    late = ~dates.is_leap_year & (dates.month > 2)
+    return dates.dayofyear.to_numpy() - 1 + late
+
+
+def day_of_year_stats(slot, temps, percentiles=()):
+    """
+    Compute the statistics of temperatures grouped by their day of year.
+
+    Args:
+        slot: a np array of the day of year of each temperature (see
+            day_of_year)
+        temps: a np array of the temperatures, without NaN
+        percentiles: the percentiles computed (list of numbers in 0-100)
+
+    Returns:
+        a dict of read-only np arrays of length 366, with the keys 'count',
+        'min', 'max', 'mean', 'std' (ddof=1) and 'p<q>' for each percentile
+        q. The days without records are NaN.
+    """
+    # One row per day of year, one column per record of that day.
+    order = np.argsort(slot, kind='stable')
+    slot = slot[order]
+    count = np.bincount(slot, minlength=366)
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    table = np.full((366, max(count.max(initial=0), 1)), np.nan)
+    table[slot, np.arange(len(slot)) - starts[slot]] = temps[order]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # empty days
+        stats = {'count': count,
+                 'min': np.nanmin(table, axis=1),
+                 'max': np.nanmax(table, axis=1),
+                 'mean': np.nanmean(table, axis=1),
+                 'std': np.nanstd(table, axis=1, ddof=1)}
+        for q in percentiles:
+            stats['p%g' % q] = np.nanpercentile(table, q, axis=1)
+    for values in stats.values():
+        values.flags.writeable = False
+    return stats
+
+
+def harmonic_fit(values, weights, harmonics):
+    """
+    Smooth annual cycles by their weighted least squares fit with a constant
+    and the given number of annual harmonics.
+
+    Args:
+        values: a (..., 366) np array of values by day of year, NaN where
+            there is no data
+        weights: a np array of the weights of the values (e.g. the number of
+            records of each day), with the shape of values
+        harmonics: number of harmonics (int)
+
+    Returns:
+        a np array of the fitted values with the shape of values, NaN for
+        the cycles with less data than coefficients.
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.where(np.isnan(values), 0, weights).astype(float)
+    angle = 2 * np.pi * np.arange(values.shape[-1]) / values.shape[-1]
+    k = np.arange(1, harmonics + 1)
+    design = np.column_stack([np.ones_like(angle), np.cos(np.outer(angle, k)),
+                              np.sin(np.outer(angle, k))])
+    lhs = np.einsum('...d,di,dj->...ij', weights, design, design)
+    rhs = np.einsum('...d,di->...i', weights * np.nan_to_num(values), design)
+    enough = (weights > 0).sum(axis=-1) >= design.shape[1]
+    lhs[~enough] = np.eye(design.shape[1])
+    fitted = np.linalg.solve(lhs, rhs[..., None])[..., 0] @ design.T
+    fitted[~enough] = np.nan
+    return fitted
+
+
+def _parse_dates(dates):
+    """
+    Convert an array of yyyymmdd ints to datetime64 with array arithmetic.
+    """
+    dates = np.asarray(dates)
+    years = (dates // 10000 - 1970).astype('datetime64[Y]')
+    months = years.astype('datetime64[M]') + (dates // 100 % 100 - 1)
+    return months.astype('datetime64[D]') + (dates % 100 - 1)
+
+
+def peak_rss():
+    """
+    Get the peak resident set size of the process since it started, in
+    bytes, or None where the resource module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
 class Climate(object):
     """
     The collection of temperature records loaded from given csv file
     """
-    def __init__(self, filename):
+    def __init__(self, filename, cache=True):
         """
         Initialize a Climate instance, which stores the temperature records
         loaded from a given csv file specified by filename in a data frame.
 
+        The prepared records, sorted by city and date, are stored in a
+        binary cache next to the csv file with their offset table and yearly
+        totals (see _read_cache), so later instances memory-map them instead
+        of parsing, cleaning and sorting the csv file.
+
         Args:
             filename: name of the csv file (str)
+            cache: whether to use the binary cache of the csv file (bool)
         """
+        stored = _read_cache(filename) if cache else None
+        if stored is not None:
+            self._restore(*stored)
+            return
 
-        self.df = pd.read_csv(filename)
-        self.df['DATE'] = pd.to_datetime(self.df['DATE'], format='%Y%m%d')
-        self.df = self.df.set_index('DATE')
-        self.df['YEAR'] = self.df.index.year
-        self.df['MONTH'] = self.df.index.month.map(dict(enumerate(calendar.month_abbr)))
-        self.df['DAY'] = self.df.index.day
+        self.df = self._prepare(_read_csv(filename))
         self.clean_data()
+        self._build_index()
+        if cache:
+            try:
+                _write_cache(filename, *self._cache_arrays())
+            except OSError:
+                pass  # e.g. read-only location: work without cache.
+
+    @classmethod
+    def stream(cls, filename, chunksize=1000000):
+        """
+        Build a Climate instance reading the csv file specified by filename in
+        chunks, for files that do not fit in memory with the default dtypes.
+        Each chunk is read with compact dtypes (category CITY, float32 TEMP,
+        int32 DATE) and cleaned on its own. The data frame has a category
+        CITY and MONTH, float32 TEMP, int16 YEAR and int8 DAY columns.
+
+        The cleaned chunks are kept in memory as compact numpy arrays. The
+        number of rows and chunks and the peak resident set size of the
+        process since it started (see peak_rss, an upper bound of the peak
+        of the load itself) are stored in the load_stats attribute.
 
-    def clean_data(self):
+        Args:
+            filename: name of the csv file (str)
+            chunksize: number of rows read at a time (int)
+
+        Returns:
+            a Climate instance.
+        """
+        climate = cls.__new__(cls)
+        names = {}
+        columns = {'CITY': [], 'TEMP': [], 'DATE': []}
+        dtypes = {'CITY': np.int32, 'TEMP': np.float32, 'DATE': np.int32}
+
+        n_chunks = 0
+        reader = pd.read_csv(filename, chunksize=chunksize,
+                             dtype={'CITY': 'category', 'TEMP': np.float32,
+                                    'DATE': np.int32})
+        for chunk in reader:
+            climate.clean_data(chunk)
+            categories = chunk['CITY'].cat.categories
+            for city in categories:
+                names.setdefault(city, len(names))
+            lookup = np.array([names[city] for city in categories], dtype=np.int32)
+            values = {'CITY': lookup[chunk['CITY'].cat.codes.to_numpy()],
+                      'TEMP': chunk['TEMP'].to_numpy(np.float32),
+                      'DATE': chunk['DATE'].to_numpy(np.int32)}
+            for key, value in values.items():
+                columns[key].append(value)
+            n_chunks += 1
+
+        columns = {key: np.concatenate(value) if value else
+                   np.array([], dtype=dtypes[key])
+                   for key, value in columns.items()}
+
+        # Categories in lexical order, so sorting by CITY sorts by name.
+        cities = sorted(names)
+        rank = np.empty(len(names), dtype=np.int32)
+        rank[[names[city] for city in cities]] = np.arange(len(cities))
+        df = pd.DataFrame({
+            'CITY': pd.Categorical.from_codes(rank[columns['CITY']], cities),
+            'TEMP': columns['TEMP'],
+            'DATE': _parse_dates(columns['DATE'])})
+        del columns
+
+        climate.df = cls._prepare(df, compact=True)
+        climate._build_index()
+        climate.load_stats = {'rows': len(df), 'chunks': n_chunks,
+                              'process_peak_rss': peak_rss()}
+        return climate
+
+    @staticmethod
+    def _prepare(df, compact=False):
+        """
+        Index the records of df by DATE and add the YEAR, MONTH and DAY
+        columns. CITY and MONTH are category columns, with the cities in
+        lexical order. If compact, the YEAR and DAY columns are stored with
+        the smallest dtypes.
+        """
+        df = df.set_index('DATE')
+        if not isinstance(df['CITY'].dtype, pd.CategoricalDtype):
+            df['CITY'] = df['CITY'].astype('category')
+        df['MONTH'] = pd.Categorical.from_codes(df.index.month - 1,
+                                                calendar.month_abbr[1:])
+        if compact:
+            df['YEAR'] = df.index.year.astype(np.int16)
+            df['DAY'] = df.index.day.astype(np.int8)
+        else:
+            df['YEAR'] = df.index.year
+            df['DAY'] = df.index.day
+        return df[['CITY', 'TEMP', 'YEAR', 'MONTH', 'DAY']]
+
+    def clean_data(self, df=None):
+        """
+        Fix the known errors of the records of df (by default, the records of
+        the climate) in place.
+        """
+        if df is None:
+            df = self.df
         # There was an error in the data stored in PHOENIX (-483°C 14-09-1964)
-        self.df.loc[self.df.TEMP < -30, 'TEMP'] = 27
+        df.loc[df.TEMP < -30, 'TEMP'] = 27
+
+    def _build_index(self):
+        """
+        Sort the records by city and date, and build the offset table used to
+        answer the queries by city and year with contiguous slices of the data
+        frame: self._offsets maps each city to a tuple (years, bounds) where
+        the records of years[k] are the rows bounds[k]:bounds[k+1].
+        """
+        self.df = self.df.sort_values(['CITY', 'DATE'], kind='stable')
+        city = self.df['CITY'].cat.codes.to_numpy()
+        names = self.df['CITY'].cat.categories
+        year = self.df['YEAR'].to_numpy()
+
+        city_change = np.flatnonzero(city[1:] != city[:-1]) + 1
+        city_bounds = np.concatenate(([0], city_change, [len(city)]))
+        offsets = {}
+        for start, stop in zip(city_bounds[:-1], city_bounds[1:]):
+            offsets[names[city[start]]] = _year_bounds(year[start:stop], start)
+        self._set_index(offsets, _yearly_totals(self.df['TEMP'].to_numpy(), offsets))
+
+    def _set_index(self, offsets, totals):
+        """
+        Set the offset table and the yearly totals of the sorted records,
+        and drop the derived data.
+        """
+        self._offsets = offsets
+        self._cities = frozenset(offsets)
+        self._years = frozenset(np.concatenate(
+            [years for years, _ in offsets.values()] or [[]]).astype(int).tolist())
+        self._totals = totals
+        self._climatologies = OrderedDict()
+        self._derived = {}
+
+    def _cache_arrays(self):
+        """
+        Get the arrays stored in the binary cache (see _write_cache): the
+        DATE index and the columns of the data frame (category columns as
+        their codes and categories), the offset table and the yearly totals,
+        with the meta dict listing the columns.
+        """
+        arrays = {'DATE': self.df.index.to_numpy()}
+        for name in self.df.columns:
+            column = self.df[name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                arrays[name + '.codes'] = column.cat.codes.to_numpy()
+                arrays[name + '.categories'] = np.asarray(column.cat.categories, dtype=str)
+            else:
+                arrays[name] = column.to_numpy()
+        cities = sorted(self._offsets)
+        arrays['offsets.cities'] = np.asarray(cities, dtype=str)
+        arrays['offsets.sizes'] = np.array([len(self._offsets[city][0]) for city in cities], dtype=int)
+        for k, part in enumerate(['years', 'bounds']):
+            arrays['offsets.' + part] = np.concatenate(
+                [self._offsets[city][k] for city in cities] or [np.array([], dtype=int)])
+        for key in self._totals.columns:
+            arrays['totals.' + key] = self._totals[key].to_numpy()
+        return arrays, {'columns': list(self.df.columns)}
+
+    def _restore(self, arrays, meta):
+        """
+        Rebuild the data frame, the offset table and the yearly totals from
+        the arrays of the binary cache (see _cache_arrays). The columns stay
+        memory-mapped.
+        """
+        data = {}
+        for name in meta['columns']:
+            if name + '.codes' in arrays:
+                data[name] = pd.Categorical.from_codes(arrays[name + '.codes'],
+                                                       arrays[name + '.categories'])
+            else:
+                data[name] = arrays[name]
+        self.df = pd.DataFrame(data, index=pd.DatetimeIndex(arrays['DATE'], name='DATE'),
+                               copy=False)
+
+        sizes = arrays['offsets.sizes']
+        year_starts = np.concatenate(([0], np.cumsum(sizes)))
+        bound_starts = year_starts + np.arange(len(sizes) + 1)
+        offsets = {}
+        for i, city in enumerate(arrays['offsets.cities'].tolist()):
+            offsets[city] = (
+                np.array(arrays['offsets.years'][year_starts[i]:year_starts[i + 1]]),
+                np.array(arrays['offsets.bounds'][bound_starts[i]:bound_starts[i + 1]]))
+        totals = pd.DataFrame({key[len('totals.'):]: np.array(values)
+                               for key, values in arrays.items()
+                               if key.startswith('totals.')},
+                              index=_totals_index(offsets))
+        self._set_index(offsets, totals)
+
+    def append(self, rows):
+        """
+        Append new temperature records to the climate. The records are cleaned
+        as the ones of the csv file, and the offset table and the yearly
+        totals are updated from the new records only when the new records of
+        a city come after its last date (the usual case for a daily feed).
+        The records are still copied into a new data frame on each call, so
+        appending costs time proportional to the size of the history: append
+        the records of a feed in batches rather than one at a time.
+
+        Args:
+            rows: a data frame with the columns of the csv file (CITY, TEMP
+                and DATE, as yyyymmdd ints or datetimes), or the name of or a
+                buffer with a csv chunk with those columns.
+        """
+        if not isinstance(rows, pd.DataFrame):
+            rows = pd.read_csv(rows)
+        new = rows.copy()
+        if not pd.api.types.is_datetime64_any_dtype(new['DATE']):
+            new['DATE'] = pd.to_datetime(new['DATE'], format='%Y%m%d')
+        new = self._prepare(new)
+        self.clean_data(new)
+        new = new.sort_values(['CITY', 'DATE'], kind='stable')[self.df.columns]
+        if not len(new):
+            return
+        new = self._conform(new)
+
+        n_old = len(self.df)
+        old_dates = self.df.index.values
+        new_city = new['CITY'].to_numpy()
+        new_year = new['YEAR'].to_numpy()
+        new_dates = new.index.values
+        change = np.flatnonzero(new_city[1:] != new_city[:-1]) + 1
+        groups = list(zip(np.concatenate(([0], change)),
+                          np.concatenate((change, [len(new)]))))
+
+        # Row of the data frame before which each new record is inserted.
+        cities = sorted(self._cities)
+        positions = np.empty(len(new), dtype=int)
+        for a, b in groups:
+            city = new_city[a]
+            if city in self._offsets:
+                start, stop = self._offsets[city][1][[0, -1]]
+                positions[a:b] = start + np.searchsorted(
+                    old_dates[start:stop], new_dates[a:b], side='right')
+            else:
+                following = cities[bisect.bisect(cities, city):]
+                positions[a:b] = self._offsets[following[0]][1][0] if following else n_old
+
+        order = np.insert(np.arange(n_old), positions, np.arange(n_old, n_old + len(new)))
+        self.df = pd.concat([self.df, new]).iloc[order]
+
+        # Shift the offsets of every city by the records inserted before it,
+        # and merge the years of the new records into the updated cities.
+        added = {new_city[a]: (a, b) for a, b in groups}
+        offsets = {}
+        shift = 0
+        for city in sorted(self._cities | set(added)):
+            years, bounds = self._offsets.get(city, (np.array([], dtype=int), np.array([0])))
+            start = shift + (bounds[0] if city in self._offsets else positions[added[city][0]])
+            bounds = bounds - bounds[0] + start
+            if city in added:
+                a, b = added[city]
+                if city not in self._offsets or \
+                        positions[a] == self._offsets[city][1][-1]:
+                    # Records after the last date: merge the year bounds.
+                    new_years, new_bounds = _year_bounds(new_year[a:b], bounds[-1])
+                    if len(years) and new_years[0] == years[-1]:
+                        years = np.concatenate((years, new_years[1:]))
+                        bounds = np.concatenate((bounds[:-1], new_bounds[1:]))
+                    else:
+                        years = np.concatenate((years, new_years))
+                        bounds = np.concatenate((bounds, new_bounds[1:]))
+                else:
+                    stop = bounds[-1] + b - a
+                    years, bounds = _year_bounds(self.df['YEAR'].to_numpy()[start:stop], start)
+                shift += b - a
+            offsets[city] = (years, bounds)
+
+        self._offsets = offsets
+        self._cities = frozenset(offsets)
+        self._years = self._years | frozenset(np.unique(new_year).tolist())
+        new_offsets = {new_city[a]: _year_bounds(new_year[a:b], a) for a, b in groups}
+        self._totals = self._totals.add(
+            _yearly_totals(new['TEMP'].to_numpy(), new_offsets), fill_value=0)
+        for key in list(self._climatologies):
+            if key[0] in added:
+                del self._climatologies[key]
+        self._derived.clear()
+
+    def _conform(self, new):
+        """
+        Cast the columns of new records to the dtypes of the data frame (e.g.
+        the compact ones of stream), adding the new cities to the categories
+        of a category CITY column, kept in lexical order.
+        """
+        dtypes = self.df.dtypes.to_dict()
+        if isinstance(dtypes['CITY'], pd.CategoricalDtype):
+            known = dtypes['CITY'].categories
+            cities = sorted(set(known) | set(new['CITY']))
+            if len(cities) > len(known):
+                self.df['CITY'] = self.df['CITY'].cat.set_categories(cities)
+                dtypes['CITY'] = self.df['CITY'].dtype
+        return new.astype(dtypes)
+
+    def cached(self, key, compute):
+        """
+        Get the derived data stored under key, computing it with compute()
+        the first time. The stored data is dropped when records are appended.
+
+        Args:
+            key: a hashable key identifying the data
+            compute: a function without arguments returning the data
+
+        Returns:
+            the data returned by compute.
+        """
+        if key not in self._derived:
+            self._derived[key] = compute()
+        return self._derived[key]
+
+    def climatology(self, city, baseline=None, percentiles=(10, 90)):
+        """
+        Get the historical statistics of the temperature of a city for each
+        day of the year. The result is memoised per (city, baseline,
+        percentiles), keeping the CLIMATOLOGY_CACHE_SIZE most recently used
+        ones, and dropped when records of the city are appended.
+
+        Args:
+            city: city name (str)
+            baseline: (first, last) years of the period used, all the years
+                by default
+            percentiles: the percentiles computed (list of numbers in 0-100)
+
+        Returns:
+            a dict of read-only np arrays of length 366 indexed by the day of
+            year in a leap year calendar (see day_of_year), with the keys
+            'count', 'min', 'max', 'mean', 'std' (ddof=1) and 'p<q>' for each
+            percentile q. The days without records are NaN.
+        """
+        key = (city, None if baseline is None else tuple(baseline),
+               tuple(percentiles))
+        if key in self._climatologies:
+            self._climatologies.move_to_end(key)
+            return self._climatologies[key]
+
+        assert city in self._cities, "provided city is not available"
+        years = None
+        if baseline is not None:
+            years = [y for y in self._years if baseline[0] <= y <= baseline[1]]
+        temps = self._take(self._slices([city], years))['TEMP'].dropna()
+        stats = day_of_year_stats(day_of_year(temps.index), temps.to_numpy(float),
+                                  percentiles)
+
+        self._climatologies[key] = stats
+        if len(self._climatologies) > CLIMATOLOGY_CACHE_SIZE:
+            self._climatologies.popitem(last=False)
+        return stats
+
+    def baseline(self, city, baseline=BASELINE, harmonics=None):
+        """
+        Get the mean temperature of a city for each day of the year over the
+        baseline period (see climatology), optionally smoothed by its fit
+        with annual harmonics (see harmonic_fit).
+
+        Args:
+            city: city name (str)
+            baseline: (first, last) years of the baseline period
+            harmonics: number of harmonics of the smoothing (int), None for
+                the raw daily means
+
+        Returns:
+            a np array of length 366 indexed by the day of year in a leap
+            year calendar (see day_of_year), NaN for the days without
+            records if not smoothed.
+        """
+        stats = self.climatology(city, baseline, percentiles=())
+        if not harmonics:
+            return stats['mean']
+        return harmonic_fit(stats['mean'], stats['count'], harmonics)
+
+    def anomalies(self, baseline=BASELINE, harmonics=None):
+        """
+        Get the temperature anomalies of the records relative to the
+        baseline of their city and day of year (see baseline), as a float32
+        array parallel to the rows of the data frame. It is cached until
+        records are appended, and the baselines are recomputed only for the
+        cities with new records.
+
+        Args:
+            baseline: (first, last) years of the baseline period
+            harmonics: number of harmonics of the baseline smoothing (int),
+                None for the raw daily means
+
+        Returns:
+            a read-only np array of float32, NaN where the baseline has no
+            records for the day.
+        """
+        def compute():
+            cities, city = self._city_codes()
+            table = np.vstack([self.baseline(name, baseline, harmonics)
+                               for name in cities] or [np.full(366, np.nan)])
+            values = self.df['TEMP'].to_numpy(float) - table[city, day_of_year(self.df.index)]
+            values = values.astype(np.float32)
+            values.flags.writeable = False
+            return values
+
+        return self.cached(('anomalies', tuple(baseline), harmonics), compute)
+
+    def yearly_totals(self, cities=None, years=None):
+        """
+        Get the number of records, the sum and the sum of squares of the
+        temperatures of each city and year. They are kept up to date by
+        append, so the yearly means and standard deviations never need a
+        full scan of the records.
+
+        Args:
+            cities: list of city names (str), all of them by default
+            years: list of the years to get the totals for (int), all of
+                them by default
+
+        Returns:
+            a data frame indexed by (CITY, YEAR) with the columns count, sum
+            and sumsq.
+        """
+        totals = self._totals
+        if cities is not None:
+            assert self._cities.issuperset(cities), "provided city is not available"
+            totals = totals[totals.index.get_level_values('CITY').isin(cities)]
+        if years is not None:
+            assert self._years.issuperset(years), "provided year is not available"
+            totals = totals[totals.index.get_level_values('YEAR').isin(years)]
+        return totals
+
+    def monthly_totals(self):
+        """
+        Get the number of records, the sum, the sum of squares, the minimum
+        and the maximum of the temperatures of each city, year and month,
+        computed by single reductions over integer city, year and month
+        codes. They are cached until records are appended.
+
+        Returns:
+            a dict with the keys 'cities' (sorted list of str), 'years'
+            (sorted np array of ints), and 'count', 'sum', 'sumsq', 'min'
+            and 'max', (cities x years x 12) np arrays (min and max are NaN
+            where there are no records).
+        """
+        return self.cached('monthly_totals', self._monthly_totals)
+
+    def _city_codes(self):
+        """
+        Get the sorted city names and the code of the city of each record
+        (its position in the names).
+        """
+        cities = self.get_cities()
+        # The records are sorted by city, so the city codes follow the offsets.
+        sizes = [self._offsets[city][1][-1] - self._offsets[city][1][0]
+                 for city in cities]
+        return cities, np.repeat(np.arange(len(cities)), sizes)
+
+    def _monthly_totals(self):
+        cities, city = self._city_codes()
+        years = np.array(self.get_years())
+        year = np.searchsorted(years, self.df['YEAR'].to_numpy())
+        month = self.df.index.month.to_numpy() - 1
+        temp = self.df['TEMP'].to_numpy(float)
+        # The records are sorted by city and date, so the cells are sorted
+        # too and the records of each cell are contiguous.
+        cell = (city * len(years) + year) * 12 + month
+        starts = np.flatnonzero(np.diff(cell, prepend=-1))
+        valid = ~np.isnan(temp)
+        shape = (len(cities), len(years), 12)
+        size = int(np.prod(shape))
+        totals = {'cities': cities, 'years': years}
+        totals['count'] = np.bincount(cell[valid], minlength=size)
+        totals['sum'] = np.bincount(cell[valid], temp[valid], minlength=size)
+        totals['sumsq'] = np.bincount(cell[valid], temp[valid]**2, minlength=size)
+        for key, reduce in [('min', np.fmin), ('max', np.fmax)]:
+            totals[key] = np.full(size, np.nan)
+            totals[key][cell[starts]] = reduce.reduceat(temp, starts)
+        for key in ['count', 'sum', 'sumsq', 'min', 'max']:
+            totals[key] = totals[key].reshape(shape)
+        return totals
+
+    def _slices(self, cities, years=None):
+        """
+        Get the row slices of the data frame holding the records of the given
+        cities and years (all the years if None), in data frame order.
+
+        Returns:
+            a list of (start, stop) tuples of row offsets.
+        """
+        slices = []
+        for city in set(cities):
+            city_years, bounds = self._offsets[city]
+            if years is None:
+                slices.append((bounds[0], bounds[-1]))
+                continue
+            wanted = np.unique(np.asarray(list(years)))
+            pos = np.searchsorted(city_years, wanted)
+            pos = pos[pos < len(city_years)]
+            pos = pos[np.isin(city_years[pos], wanted)]
+            slices.extend(zip(bounds[pos], bounds[pos+1]))
+
+        # Merge the adjacent slices.
+        merged = []
+        for start, stop in sorted(slices):
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], stop)
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def _rows(self, slices):
+        """
+        Get the row numbers of the given row slices, as a slice if there is
+        only one.
+        """
+        if len(slices) == 1:
+            return slice(*slices[0])
+        rows = [np.arange(start, stop) for start, stop in slices]
+        return np.concatenate(rows) if rows else np.array([], dtype=int)
+
+    def _take(self, slices):
+        """
+        Get the rows of the data frame for the given row slices.
+        """
+        return self.df.iloc[self._rows(slices)]
 
     def get_df(self):
         return self.df
@@ -55,7 +842,7 @@ class Climate(object):
         Return:
             list of string of the names of the cities.
         """
-        return list(set(self.df['CITY']))
+        return sorted(self._cities)
 
     def get_years(self):
         """
@@ -68,35 +855,58 @@ class Climate(object):
             list of string of ints for the years recorded.
         """
 
-        return list(set(self.df['YEAR']))
+        return sorted(self._years)
 
     def filter_by(self, **kwargs):
         """
         Filter the climate date frame temperatures for the given list of years,
         cities, months or days.
 
+        The cities and years are looked up in the offset table, so only the
+        months and days filters scan the selected records.
+
         Args:
             cities: list of city names (str)
             years: list of the years to get the data for (int)
             months: list of the months to get the data for (int)
             days: list of the days to get the data for (int)
+            anomaly: get the temperature anomalies instead of the
+                temperatures (bool, see anomalies)
+            baseline: (first, last) years of the baseline of the anomalies,
+                BASELINE by default
+            harmonics: number of harmonics of the baseline smoothing of the
+                anomalies (int), None by default
 
         Returns:
-            a temporal series of temperatures for the specified parameters.
-        """
-        df = self.df
-        for key, values in kwargs.items():
-            if key == 'cities':
-                assert set(values).issubset(self.get_cities()), "provided city is not available"
-                df = df[df['CITY'].isin(values)]
-            elif key == 'years':
-                assert set(values).issubset(self.get_years()), "provided year is not available"
-                df = df[df['YEAR'].isin(values)]
-            elif key == 'months':
-                df = df[df.index.month.isin(values)]
-            elif key == 'days':
-                df = df[df.index.day.isin(values)]
-        return df['TEMP']
+            a temporal series of temperatures (TEMP) or anomalies (ANOMALY)
+            for the specified parameters.
+        """
+        cities = kwargs.get('cities')
+        years = kwargs.get('years')
+        if cities is not None:
+            assert self._cities.issuperset(cities), "provided city is not available"
+        if years is not None:
+            years = set(years)
+            assert self._years.issuperset(years), "provided year is not available"
+
+        if cities is None and years is None:
+            rows = slice(None)
+        else:
+            rows = self._rows(self._slices(self._cities if cities is None
+                                           else cities, years))
+        df = self.df.iloc[rows]
+        if kwargs.get('anomaly'):
+            values = self.anomalies(kwargs.get('baseline', BASELINE),
+                                    kwargs.get('harmonics'))
+            series = pd.Series(values[rows], index=df.index, name='ANOMALY')
+        else:
+            series = df['TEMP']
+
+        if 'months' in kwargs:
+            series = series[series.index.month.isin(kwargs['months'])]
+        if 'days' in kwargs:
+            series = series[series.index.day.isin(kwargs['days'])]
+        return series
 
     def get_yearly_temp(self, city, year):
         """
@@ -113,9 +923,27 @@ class Climate(object):
 
         return self.filter_by(cities=[city], years=[year]).values
 
+    def _lookup_table(self):
+        """
+        Build the point lookup table: a (cities x days) array with the row
+        of the record of each city and day since the first date, -1 where
+        there is none, so a record is found by direct addressing.
+        """
+        cities, city = self._city_codes()
+        dates = self.df.index.values.astype('datetime64[D]')
+        first = dates.min()
+        day = (dates - first).astype(np.int64)
+        rows = np.full((len(cities), day.max() + 1), -1, dtype=np.int64)
+        rows[city, day] = np.arange(len(dates))
+        return {'cities': pd.Index(cities), 'codes': dict(zip(cities, range(len(cities)))),
+                'first': first, 'ordinal': first.item().toordinal(), 'rows': rows,
+                'temps': self.df['TEMP'].to_numpy()}
+
     def get_daily_temp(self, city, month, day, year):
         """
         Get the daily temperature for the given city and time (year + date).
+        The record is found in constant time in the lookup table, built on
+        the first call and again after records are appended.
 
         Args:
             city: city name (str)
@@ -128,11 +956,347 @@ class Climate(object):
             a float of the daily temperature for the specified time (year +
             date) and city
         """
-        date = calendar.datetime.date(year, month, day)
-        assert city in self.get_cities(), "provided city is not available"
-        assert date in self.df[self.df['CITY'] == city].index, "provided date is not available in the city"
+        table = self.cached('lookup', self._lookup_table)
+        assert city in self._cities, "provided city is not available"
+        rows = table['rows']
+        i = calendar.datetime.date(year, month, day).toordinal() - table['ordinal']
+        row = rows[table['codes'][city], i] if 0 <= i < rows.shape[1] else -1
+        assert row >= 0, "provided date is not available in the city"
+
+        return table['temps'][row]
+
+    def get_daily_temps(self, cities, dates):
+        """
+        Get the daily temperatures of many (city, date) pairs at once, with
+        the lookup table of get_daily_temp.
+
+        Args:
+            cities: a city name (str) or a list of city names, one per date
+            dates: list of dates (anything convertible to datetime64, e.g.
+                datetime.date or 'YYYY-MM-DD' strings)
+
+        Returns:
+            a np array of the temperatures, NaN where the city has no record
+            for the date.
+        """
+        table = self.cached('lookup', self._lookup_table)
+        rows = table['rows']
+        days = (np.asarray(dates, dtype='datetime64[D]') - table['first']).astype(np.int64)
+        codes = table['cities'].get_indexer(np.broadcast_to(cities, days.shape))
+        assert (codes >= 0).all(), "provided city is not available"
+        inside = (days >= 0) & (days < rows.shape[1])
+        row = np.full(days.shape, -1, dtype=np.int64)
+        row[inside] = rows[codes[inside], days[inside]]
+        temps = table['temps'][row].astype(float)
+        temps[row < 0] = np.nan
+        return temps
+
+
+class ClimateCube(object):
+    """
+    The temperature records stored as a dense (cities x days) array on the
+    shared daily calendar of all the cities. Missing days are NaN.
+
+    It exposes the query methods of Climate (filter_by, get_yearly_temp,
+    get_daily_temp, ...) and the yearly and day-of-year reductions as
+    vectorised operations along the days axis. With the default float32
+    storage the temperatures are exact to float32 precision only.
+    """
+    def __init__(self, filename, cache=True, dtype=np.float32):
+        """
+        Initialize a ClimateCube instance from the csv file specified by
+        filename (see Climate).
+
+        Args:
+            filename: name of the csv file (str)
+            cache: whether to use the binary cache of the csv file (bool)
+            dtype: numpy dtype of the temperatures array
+        """
+        self._build(Climate(filename, cache=cache).get_df(), dtype)
+
+    @classmethod
+    def from_climate(cls, climate, dtype=np.float32):
+        """
+        Build a ClimateCube from the records of a Climate instance.
+        """
+        cube = cls.__new__(cls)
+        cube._build(climate.get_df(), dtype)
+        return cube
+
+    def _build(self, df, dtype):
+        """
+        Scatter the records of df (sorted by city and date) into the dense
+        array and compute the code arrays of the calendar.
+        """
+        self.cities = np.unique(df['CITY'].to_numpy().astype(str))
+        self.dates = pd.date_range(df.index.min(), df.index.max(), freq='D',
+                                   name='DATE')
+        self._city_code = {city: i for i, city in enumerate(self.cities)}
+
+        city = np.searchsorted(self.cities, df['CITY'].to_numpy().astype(str))
+        day = (df.index - self.dates[0]).days.to_numpy()
+        self.temps = np.full((len(self.cities), len(self.dates)), np.nan,
+                             dtype=dtype)
+        self.temps[city, day] = df['TEMP'].to_numpy()
+
+        # Code arrays of the calendar.
+        self.city = np.arange(len(self.cities), dtype=np.int16)
+        self.year = self.dates.year.to_numpy().astype(np.int16)
+        self.month = self.dates.month.to_numpy().astype(np.int8)
+        self.day = self.dates.day.to_numpy().astype(np.int8)
+        self.doy = day_of_year(self.dates).astype(np.int16)
+
+        self.years = np.unique(self.year)
+        self._year_starts = np.searchsorted(self.year, self.years)
+        self._doy_order = np.argsort(self.doy, kind='stable')
+        self._doy_starts = np.searchsorted(self.doy[self._doy_order],
+                                           np.arange(366))
+
+    def cached(self, key, compute):
+        """
+        Get the derived data stored under key, computing it with compute()
+        the first time (see Climate.cached).
+        """
+        derived = self.__dict__.setdefault('_derived', {})
+        if key not in derived:
+            derived[key] = compute()
+        return derived[key]
+
+    def get_df(self):
+        """
+        Get the records as a data frame with the layout of Climate.get_df.
+        """
+        city, day = np.nonzero(~np.isnan(self.temps))
+        dates = self.dates[day]
+        df = pd.DataFrame({'CITY': self.cities[city],
+                           'TEMP': self.temps[city, day].astype(float)},
+                          index=dates)
+        df['YEAR'] = dates.year
+        df['MONTH'] = dates.month.map(dict(enumerate(calendar.month_abbr)))
+        df['DAY'] = dates.day
+        return df
+
+    def get_cities(self):
+        """
+        Get the name of the cities recorded in the cube.
+
+        Return:
+            list of string of the names of the cities.
+        """
+        return self.cities.tolist()
+
+    def get_years(self):
+        """
+        Get the years recorded in the cube.
+
+        Return:
+            list of ints for the years recorded.
+        """
+        return self.years.tolist()
+
+    def _city_rows(self, cities):
+        """
+        Get the sorted row numbers of the given cities.
+        """
+        assert set(cities).issubset(self._city_code), "provided city is not available"
+        return np.unique([self._city_code[city] for city in cities]).astype(int)
+
+    def filter_by(self, **kwargs):
+        """
+        Filter the temperatures or the anomalies for the given list of years,
+        cities, months or days (see Climate.filter_by).
+
+        Returns:
+            a temporal series of temperatures for the specified parameters,
+            ordered by city and date.
+        """
+        rows = self.city
+        if 'cities' in kwargs:
+            rows = self._city_rows(kwargs['cities'])
+        mask = np.ones(len(self.dates), dtype=bool)
+        if 'years' in kwargs:
+            assert set(kwargs['years']).issubset(self.years.tolist()), "provided year is not available"
+            mask &= np.isin(self.year, list(kwargs['years']))
+        if 'months' in kwargs:
+            mask &= np.isin(self.month, list(kwargs['months']))
+        if 'days' in kwargs:
+            mask &= np.isin(self.day, list(kwargs['days']))
+
+        temps = self.temps[rows][:, mask]
+        valid = ~np.isnan(temps)
+        dates = np.broadcast_to(self.dates[mask].to_numpy(), temps.shape)
+        values, name = temps[valid], 'TEMP'
+        if kwargs.get('anomaly'):
+            anomalies = self.anomalies(kwargs.get('baseline', BASELINE),
+                                       kwargs.get('harmonics'))
+            values, name = anomalies[rows][:, mask][valid], 'ANOMALY'
+        return pd.Series(values.astype(float), name=name,
+                         index=pd.DatetimeIndex(dates[valid], name='DATE'))
+
+    def get_yearly_temp(self, city, year):
+        """
+        Get the daily temperatures for the given year and city.
+
+        Returns:
+            a 1-d numpy array of daily temperatures for the specified year and
+            city
+        """
+        return self.filter_by(cities=[city], years=[year]).values
+
+    def get_daily_temp(self, city, month, day, year):
+        """
+        Get the daily temperature for the given city and time (year + date).
+
+        Returns:
+            a float of the daily temperature for the specified time (year +
+            date) and city
+        """
+        assert city in self._city_code, "provided city is not available"
+        i = (pd.Timestamp(year, month, day) - self.dates[0]).days
+        assert 0 <= i < len(self.dates), "provided date is not available in the city"
+        temp = self.temps[self._city_code[city], i]
+        assert not np.isnan(temp), "provided date is not available in the city"
+        return float(temp)
+
+    def get_daily_temps(self, cities, dates):
+        """
+        Get the daily temperatures of many (city, date) pairs at once (see
+        Climate.get_daily_temps).
+        """
+        codes = pd.Index(self.cities).get_indexer(
+            np.broadcast_to(cities, np.shape(dates)))
+        assert (codes >= 0).all(), "provided city is not available"
+        days = (np.asarray(dates, dtype='datetime64[D]')
+                - self.dates[0].to_datetime64().astype('datetime64[D]')).astype(np.int64)
+        inside = (days >= 0) & (days < len(self.dates))
+        temps = np.full(days.shape, np.nan)
+        temps[inside] = self.temps[codes[inside], days[inside]]
+        return temps
+
+    def anomalies(self, baseline=BASELINE, harmonics=None):
+        """
+        Get the temperature anomalies relative to the mean temperature of
+        each city and day of year over the baseline period, optionally
+        smoothed (see Climate.anomalies). They are cached.
+
+        Returns:
+            a read-only (cities x days) np array of float32.
+        """
+        def compute():
+            inside = (self.year >= baseline[0]) & (self.year <= baseline[1])
+            temps = np.where(inside, self.temps, np.nan)[:, self._doy_order]
+            valid = ~np.isnan(temps)
+            count = np.add.reduceat(valid, self._doy_starts, axis=1)
+            total = np.add.reduceat(np.where(valid, temps, 0), self._doy_starts, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / count
+            if harmonics:
+                mean = harmonic_fit(mean, count, harmonics)
+            values = (self.temps - mean[:, self.doy]).astype(np.float32)
+            values.flags.writeable = False
+            return values
+
+        return self.cached(('anomalies', tuple(baseline), harmonics), compute)
+
+    def _reduce(self, starts, order=None):
+        """
+        Compute the count, sum and sum of squares of the temperatures of each
+        city over the groups of days beginning at starts (after reordering
+        the days by order).
+        """
+        temps = self.temps if order is None else self.temps[:, order]
+        valid = ~np.isnan(temps)
+        values = np.where(valid, temps, 0).astype(float)
+        count = np.add.reduceat(valid, starts, axis=1)
+        total = np.add.reduceat(values, starts, axis=1)
+        squares = np.add.reduceat(values**2, starts, axis=1)
+        return count, total, squares
+
+    def yearly_mean(self):
+        """
+        Get the yearly mean temperature of each city.
+
+        Returns:
+            a (cities x years) numpy array, NaN where a city has no records.
+        """
+        count, total, _ = self._reduce(self._year_starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+
+    def yearly_std(self):
+        """
+        Get the standard deviation of the daily temperatures of each city and
+        year.
+
+        Returns:
+            a (cities x years) numpy array, NaN where a city has no records.
+        """
+        count, total, squares = self._reduce(self._year_starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            return np.sqrt(np.maximum(squares / count - mean**2, 0))
 
-        return self.df[self.df['CITY'] == city].loc[date].TEMP
+    def yearly_totals(self, cities=None, years=None):
+        """
+        Get the number of records, the sum and the sum of squares of the
+        temperatures of each city and year (see Climate.yearly_totals).
+        """
+        count, total, squares = self._reduce(self._year_starts)
+        index = pd.MultiIndex.from_product([self.cities, self.years.astype(int)],
+                                           names=['CITY', 'YEAR'])
+        totals = pd.DataFrame({'count': count.ravel(), 'sum': total.ravel(),
+                               'sumsq': squares.ravel()}, index=index)
+        totals = totals[totals['count'] > 0]
+        if cities is not None:
+            self._city_rows(cities)
+            totals = totals[totals.index.get_level_values('CITY').isin(cities)]
+        if years is not None:
+            assert set(years).issubset(self.years.tolist()), "provided year is not available"
+            totals = totals[totals.index.get_level_values('YEAR').isin(years)]
+        return totals
+
+    def monthly_totals(self):
+        """
+        Get the number of records, the sum, the sum of squares, the minimum
+        and the maximum of the temperatures of each city, year and month
+        (see Climate.monthly_totals).
+        """
+        return self.cached('monthly_totals', self._monthly_totals)
+
+    def _monthly_totals(self):
+        # The days of a month are contiguous, so each month present in the
+        # calendar is one group of the reduction.
+        years = self.years.astype(int)
+        key = (self.year - self.years[0]).astype(int) * 12 + self.month - 1
+        present, starts = np.unique(key, return_index=True)
+        reductions = dict(zip(['count', 'sum', 'sumsq'], self._reduce(starts)))
+        temps = self.temps.astype(float)
+        reductions['min'] = np.fmin.reduceat(temps, starts, axis=1)
+        reductions['max'] = np.fmax.reduceat(temps, starts, axis=1)
+        totals = {'cities': list(self.cities), 'years': years}
+        for key, values in reductions.items():
+            fill = np.nan if key in ('min', 'max') else 0
+            array = np.full((len(self.cities), len(years) * 12), fill,
+                            dtype=int if key == 'count' else float)
+            array[:, present] = values
+            totals[key] = array.reshape(len(self.cities), len(years), 12)
+        return totals
+
+    def climatology(self, city, baseline=None, percentiles=(10, 90)):
+        """
+        Get the historical statistics of the temperature of a city for each
+        day of the year (see Climate.climatology). They are cached.
+        """
+        def compute():
+            temps = self.temps[self._city_rows([city])[0]].astype(float)
+            valid = ~np.isnan(temps)
+            if baseline is not None:
+                valid &= (self.year >= baseline[0]) & (self.year <= baseline[1])
+            return day_of_year_stats(self.doy[valid], temps[valid], percentiles)
+
+        key = ('climatology', city, None if baseline is None else tuple(baseline),
+               tuple(percentiles))
+        return self.cached(key, compute)
 
 
 def se_over_slope(x, y, estimated, model):
@@ -185,35 +1349,161 @@ def generate_models(x, y, degs):
     return [np.polyfit(x,y,deg) for deg in degs]
 
 
-def r_squared(y, estimated):
+def fit_models(x, ys, degs):
+    """
+    Fit a polynomial for each degree in degs to every series of ys, which
+    share the x-coordinates, and evaluate the fits.
+
+    For each degree the Vandermonde matrix is built once and all the series
+    are solved in a single least squares call, and the metrics are computed
+    as array reductions over the series.
+
+    Args:
+        x: an 1-d np array with length N, representing the x-coordinates of
+            the N sample points
+        ys: an 1-d np array with length N, or a 2-d np array with shape
+            (M, N) holding M series of y-coordinates of the N sample points
+        degs: a list of degrees of the fitting polynomial
+
+    Returns:
+        a list with a dict for each degree in degs, with the keys:
+            'coefficients': (M, deg+1) np array of the coefficients of each
+                series, highest power first (as np.polyfit)
+            'estimated': (M, N) np array of the values estimated by each fit
+            'r_squared': (M,) np array of the R-squared of each fit
+            'rmse': (M,) np array of the root mean square error of each fit
+            'se_over_slope': (M,) np array of the ratio of the standard
+                error of the slope to the slope (NaN unless deg is 1)
+    """
+    x = np.asarray(x, dtype=float)
+    ys = np.atleast_2d(np.asarray(ys, dtype=float))
+    n = len(x)
+    ss_tot = np.sum((ys - ys.mean(axis=1, keepdims=True))**2, axis=1)
+    var_x = np.sum((x - x.mean())**2)
+
+    fits = []
+    for deg in degs:
+        vander = np.vander(x, deg + 1)
+        # Scale the columns to improve the conditioning, as np.polyfit does.
+        scale = np.sqrt(np.sum(vander**2, axis=0))
+        coefficients = np.linalg.lstsq(vander / scale, ys.T, rcond=None)[0]
+        coefficients = coefficients.T / scale
+        estimated = coefficients @ vander.T
+        sse = np.sum((ys - estimated)**2, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if deg == 1:
+                se = np.sqrt(sse / (n - 2) / var_x)
+                se_slope = se / coefficients[:, 0]
+            else:
+                se_slope = np.full(len(ys), np.nan)
+            fits.append({'coefficients': coefficients,
+                         'estimated': estimated,
+                         'r_squared': 1 - sse / ss_tot,
+                         'rmse': np.sqrt(sse / n),
+                         'se_over_slope': se_slope})
+    return fits
+
+def r_squared(y, estimated, axis=-1):
     """
     Calculate the R-squared error term.
 
     Args:
         y: 1-d np array with length N, representing the y-coordinates of the
-            N sample points
+            N sample points, or a n-d np array of such series
         estimated: an 1-d np array of values estimated by the regression
-            model
+            model, or a n-d np array broadcastable with y
+        axis: the axis of the sample points (int)
 
     Returns:
-        a float for the R-squared error term
+        a float for the R-squared error term, or a np array with one per
+        series
     """
-    mean = np.mean(y)
-    return 1-sum((y-estimated)**2)/sum((y-mean)**2)
+    y, estimated = np.broadcast_arrays(np.asarray(y, dtype=float),
+                                       np.asarray(estimated, dtype=float))
+    mean = np.mean(y, axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = 1 - np.sum((y - estimated)**2, axis=axis) / np.sum((y - mean)**2, axis=axis)
+    return float(result) if np.ndim(result) == 0 else result
+
+def evaluate_models(x, ys, models):
+    """
+    Evaluate every regression model on every series of ys, which share the
+    x-coordinates, as array reductions over the models and the series.
 
-def evaluate_models_on_training(x, y, models):
+    Args:
+        x: an 1-d np array with length N, representing the x-coordinates of
+            the N sample points
+        ys: an 1-d np array with length N, or a 2-d np array with shape
+            (M, N) holding M series of y-coordinates of the N sample points
+        models: a list of the coefficients of the polynomials (np arrays,
+            highest power first)
+
+    Returns:
+        a data frame with a row per model and series, and the columns model
+        (index in models), degree, series (row of ys), r_squared, rmse and
+        se_over_slope (NaN unless the degree is 1).
+    """
+    x = np.asarray(x, dtype=float)
+    ys = np.atleast_2d(np.asarray(ys, dtype=float))
+    estimated = np.array([np.polyval(coefficients, x) for coefficients in models])
+    degrees = np.array([len(coefficients) - 1 for coefficients in models])
+    slopes = np.array([coefficients[0] for coefficients in models], dtype=float)
+
+    # (models x series) metrics
+    sse = np.sum((ys[None] - estimated[:, None])**2, axis=-1)
+    var_x = np.sum((x - x.mean())**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se = np.sqrt(sse / (len(x) - 2) / var_x) / slopes[:, None]
+    se[degrees != 1] = np.nan
+    shape = sse.shape
+    return pd.DataFrame({'model': np.repeat(np.arange(len(models)), shape[1]),
+                         'degree': np.repeat(degrees, shape[1]),
+                         'series': np.tile(np.arange(shape[1]), shape[0]),
+                         'r_squared': r_squared(ys[None], estimated[:, None]).ravel(),
+                         'rmse': np.sqrt(sse / len(x)).ravel(),
+                         'se_over_slope': se.ravel()})
+
+def _plot_models(x, y, models, titles, labels, data_label, steps, filename):
+    """
+    Plot the data points (x, y) as blue dots with the curve of each model as
+    a red line, one page per model, into the pdf file filename. The figures
+    are not attached to pyplot, so nothing is shown and nothing blocks.
+    """
+    # The plotting libraries are only loaded when a plot is made.
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.figure import Figure
+    import matplotlib.ticker as ticker
+
+    with PdfPages(filename) as pages:
+        for coefficients, title, label in zip(models, titles, labels):
+            fig = Figure(facecolor='#eeeeee')
+            ax = fig.subplots()
+            ax.plot(x, y, 'bo', label=data_label)
+            ax.plot(x, np.polyval(coefficients, x), 'r', label=label)
+            ax.set_title(title, size=18, family='fantasy', fontweight="normal")
+            ax.legend(loc='upper left', bbox_to_anchor=(1, 0.7),
+                      fancybox=True, shadow=True, ncol=1)
+            ax.tick_params(axis='both', which='major', labelsize=14)
+            ax.tick_params(axis='both', which='minor', labelsize=8)
+
+            ax.xaxis.set_major_locator(ticker.MultipleLocator(steps[0]))
+            ax.yaxis.set_major_locator(ticker.MultipleLocator(steps[1]))
+
+            ax.set_xlabel('Years', size=16, weight='normal', color='black')
+            ax.set_ylabel('Temperature [°C]', size=16, weight='normal', color='black')
+            pages.savefig(fig, bbox_inches='tight')
+
+def evaluate_models_on_training(x, y, models, filename=None):
     """
     For each regression model, compute the R-squared value for this model with the
     standard error over slope of a linear regression line (only if the model is
-    linear), and plot the data along with the best fit curve.
+    linear), and optionally plot the data along with the best fit curve.
 
-    For the plots, you should plot data points (x,y) as blue dots and your best
-    fit curve (aka model) as a red solid line. You should also label the axes
-    of this figure appropriately and have a title reporting the following
-    information:
-        degree of your regression model,
-        R-square of your model evaluated on the given data points,
-        and SE/slope (if degree of this model is 1 -- see se_over_slope).
+    The plots show the data points (x,y) as blue dots and the best fit curve
+    (aka model) as a red solid line, with a title reporting the degree of the
+    regression model, its R-square evaluated on the given data points, and
+    SE/slope (if degree of this model is 1 -- see se_over_slope).
 
     Args:
         x: an 1-d np array with length N, representing the x-coordinates of
@@ -223,42 +1513,30 @@ def evaluate_models_on_training(x, y, models):
         models: a list containing the regression models you want to apply to
             your data. Each model is a np array storing the coefficients of
             a polynomial.
+        filename: name of the pdf file where the plots are written, one page
+            per model. By default, nothing is plotted.
 
     Returns:
-        None
-    """
-    fig, ax = plt.subplots(facecolor='#eeeeee')
-    for coefficients in models:
-        plt.plot(x, y, 'bo', label='Training Data')
-        degree = len(coefficients) - 1
-        estimated = np.polyval(coefficients, x)
-        r_sq_error = r_squared(y, estimated)
-        title = ''
-        if degree == 1:
-            se = se_over_slope(x, y, estimated, coefficients)
-            title = 'Linear fit with '
-            label2 = 'SE = '+str(round(se, 2))
-
-        elif degree == 2:
-            title = 'Cuadaratic fit with '
-            label2 = 'Cuadratic model'
-        else:
-            label2 = ''
-        title += r'$R^2 = $' + str(round(r_sq_error, 3))
-        plt.plot(x, estimated, 'r', label=label2)
-
-        plt.title(title, size=18, family='fantasy', fontweight="normal")
-        plt.legend(loc='upper left', bbox_to_anchor=(1, 0.7),
-           fancybox=True, shadow=True, ncol=1)
-        ax.tick_params(axis='both', which='major', labelsize=14)
-        ax.tick_params(axis='both', which='minor', labelsize=8)
-
-        ax.xaxis.set_major_locator(ticker.MultipleLocator(10))
-        ax.yaxis.set_major_locator(ticker.MultipleLocator(0.2))
-
-        plt.xlabel('Years', size=16, weight='normal', color='black')
-        plt.ylabel('Temperature [°C]', size=16, weight='normal', color='black')
-        plt.show()
+        the data frame of the metrics of each model (see evaluate_models).
+    """
+    table = evaluate_models(x, y, models)
+    if filename is not None:
+        titles, labels = [], []
+        for row in table.itertuples():
+            title = ''
+            if row.degree == 1:
+                title = 'Linear fit with '
+                label2 = 'SE = '+str(round(row.se_over_slope, 2))
+            elif row.degree == 2:
+                title = 'Cuadaratic fit with '
+                label2 = 'Cuadratic model'
+            else:
+                label2 = ''
+            titles.append(title + r'$R^2 = $' + str(round(row.r_squared, 3)))
+            labels.append(label2)
+        _plot_models(x, y, models, titles, labels, 'Training Data', (10, 0.2),
+                     filename)
+    return table
 
 def gen_cities_avg(climate, multi_cities, years):
     """
@@ -275,42 +1553,57 @@ def gen_cities_avg(climate, multi_cities, years):
         this array corresponds to the average annual temperature over the given
         cities for a given year.
     """
-    df = climate.filter_by(cities=multi_cities, years=years)
-    return df.groupby('{:%Y}'.format).mean().values
+    totals = climate.yearly_totals(multi_cities, years)
+    totals = totals.groupby(level='YEAR').sum()
+    return (totals['sum'] / totals['count']).values
 
-def moving_average(y, window_length):
+def moving_average(y, window_length, axis=-1):
     """
     Compute the moving average of y with specified window length.
 
+    The first window_length - 1 elements are the averages of all the
+    preceding elements. It runs in O(N) using cumulative sums, and a 2-d
+    array (e.g. one row per city) is averaged along the given axis. A NaN
+    only makes NaN the windows that contain it.
+
     Args:
         y: an 1-d np array with length N, representing the y-coordinates of
-            the N sample points
+            the N sample points, or a n-d np array of such series
         window_length: an integer indicating the window length for computing
             moving average
+        axis: the axis along which the moving average is computed (int)
 
     Returns:
-        an 1-d numpy array with the same length as y storing moving average of
+        a numpy array with the same shape as y storing moving average of
         y-coordinates of the N sample points
     """
     n = window_length
-    init_sum = [sum(y[:i+1])/(i+1) for i in range(n-1)]
-    final_sum = [sum(y[i:i+n])/n for i in range(len(y)-n+1)]
-    return np.array(init_sum + final_sum)
-
-def rmse(y, estimated):
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    sums = np.cumsum(np.nan_to_num(y), axis=-1)
+    nans = np.cumsum(np.isnan(y), axis=-1)
+    sums[..., n:] = sums[..., n:] - sums[..., :-n]
+    nans[..., n:] = nans[..., n:] - nans[..., :-n]
+    counts = np.minimum(np.arange(1, sums.shape[-1] + 1), n)
+    return np.moveaxis(np.where(nans > 0, np.nan, sums / counts), -1, axis)
+
+def rmse(y, estimated, axis=-1):
     """
     Calculate the root mean square error term.
 
     Args:
         y: an 1-d numpy array with length N, representing the y-coordinates of
-            the N sample points
+            the N sample points, or a n-d np array of such series
         estimated: an 1-d np array of values estimated by the regression
-            model
+            model, or a n-d np array broadcastable with y
+        axis: the axis of the sample points (int)
 
     Returns:
-        a float for the root mean square error term
+        a float for the root mean square error term, or a np array with one
+        per series
     """
-    return np.sqrt(sum((y-estimated)**2)/len(y))
+    y, estimated = np.broadcast_arrays(np.asarray(y, dtype=float),
+                                       np.asarray(estimated, dtype=float))
+    return np.sqrt(np.mean((y - estimated)**2, axis=axis))
 
 
 def gen_std_devs(climate, multi_cities, years):
@@ -329,25 +1622,20 @@ def gen_std_devs(climate, multi_cities, years):
         city temperatures for the given cities in a given year.
     """
 
-    to_date = calendar.datetime.datetime.strptime
     df = climate.filter_by(cities=multi_cities, years=years)
-    df = df.groupby('{:%Y-%m-%d}'.format).mean()
-    df.index = df.index.map(lambda x: to_date(x, '%Y-%m-%d' ))
+    daily = df.groupby(level='DATE').mean()
+    std_devs = daily.groupby(daily.index.year).std(ddof=0)
+    return std_devs.reindex(years).values
 
-    return np.array([df[df.index.year == year].values.std() for year in years])
 
-
-def evaluate_models_on_testing(x, y, models):
+def evaluate_models_on_testing(x, y, models, filename=None):
     """
-    For each regression model, compute the RMSE for this model and plot the
-    test data along with the model’s estimation.
+    For each regression model, compute the RMSE for this model and optionally
+    plot the test data along with the model’s estimation.
 
-    For the plots, you should plot data points (x,y) as blue dots and your best
-    fit curve (aka model) as a red solid line. You should also label the axes
-    of this figure appropriately and have a title reporting the following
-    information:
-        degree of your regression model,
-        RMSE of your model evaluated on the given data points.
+    The plots show the data points (x,y) as blue dots and the model as a red
+    solid line, with a title reporting the degree of the regression model and
+    its RMSE evaluated on the given data points.
 
     Args:
         x: an 1-d np array with length N, representing the x-coordinates of
@@ -357,39 +1645,30 @@ def evaluate_models_on_testing(x, y, models):
         models: a list containing the regression models you want to apply to
             your data. Each model is a np array storing the coefficients of
             a polynomial.
+        filename: name of the pdf file where the plots are written, one page
+            per model. By default, nothing is plotted.
 
     Returns:
-        None
-    """
-    fig, ax = plt.subplots(facecolor='#eeeeee')
-    for coefficients in models:
-        plt.plot(x, y, 'bo', label='Testing Data')
-        degree = len(coefficients) - 1
-        estimated = np.polyval(coefficients, x)
-        root_meam_sq_err = rmse(y, estimated)
-        title = 'Prediction - '
-        if degree == 1:
-            title += 'Linear model -'
-        elif degree == 2:
-            title += 'Cuadaratic model -'
-
-        label = r'$rmse = $' + str(round(root_meam_sq_err,2))
-        plt.plot(x, estimated, 'r', label=label)
-        plt.title(title, size=18, family='fantasy', fontweight="normal")
-        plt.legend(loc='upper left', bbox_to_anchor=(1, 0.7),
-           fancybox=True, shadow=True, ncol=1)
-        ax.tick_params(axis='both', which='major', labelsize=14)
-        ax.tick_params(axis='both', which='minor', labelsize=8)
-
-        ax.xaxis.set_major_locator(ticker.MultipleLocator(1))
-        ax.yaxis.set_major_locator(ticker.MultipleLocator(0.1))
-
-        plt.xlabel('Years', size=16, weight='normal', color='black')
-        plt.ylabel('Temperature [°C]', size=16, weight='normal', color='black')
-        plt.show()
+        the data frame of the metrics of each model (see evaluate_models).
+    """
+    table = evaluate_models(x, y, models)
+    if filename is not None:
+        titles, labels = [], []
+        for row in table.itertuples():
+            title = 'Prediction - '
+            if row.degree == 1:
+                title += 'Linear model -'
+            elif row.degree == 2:
+                title += 'Cuadaratic model -'
+            titles.append(title)
+            labels.append(r'$rmse = $' + str(round(row.rmse, 2)))
+        _plot_models(x, y, models, titles, labels, 'Testing Data', (1, 0.1),
+                     filename)
+    return table
 
 
 if __name__ == '__main__':
+    import seaborn as sns
 
     climate = Climate('data.csv')
     sns.set_theme(style='darkgrid')
@@ -401,17 +1680,20 @@ if __name__ == '__main__':
     national_yearly_temp = gen_cities_avg(climate, CITIES, TRAINING_INTERVAL)
     moving_avg_temp = moving_average(national_yearly_temp, window_length=5)
     model = generate_models(TRAINING_INTERVAL, moving_avg_temp, [1])
-    evaluate_models_on_training(TRAINING_INTERVAL, moving_avg_temp, model)
+    print(evaluate_models_on_training(TRAINING_INTERVAL, moving_avg_temp, model,
+                                      'part_a_training.pdf'))
 
 
     # Part B
     national_yearly_temp = gen_cities_avg(climate, CITIES, TESTING_INTERVAL)
     moving_avg_temp = moving_average(national_yearly_temp, window_length=5)
-    evaluate_models_on_testing(TESTING_INTERVAL, moving_avg_temp, model)
+    print(evaluate_models_on_testing(TESTING_INTERVAL, moving_avg_temp, model,
+                                     'part_b_testing.pdf'))
 
     # Part C
     std_devs = gen_std_devs(climate, CITIES, TRAINING_INTERVAL)
     moving_aver = moving_average(std_devs, window_length=5)
     model = generate_models(TRAINING_INTERVAL, moving_aver, [1])
-    evaluate_models_on_training(TRAINING_INTERVAL, moving_aver, model)
+    print(evaluate_models_on_training(TRAINING_INTERVAL, moving_aver, model,
+                                      'part_c_training.pdf'))
 
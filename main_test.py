@@ -6,7 +6,11 @@ Created on Fri Apr  9 19:24:08 2021
 
 import unittest
 import numpy as np
+import pandas as pd
 import math
+import os
+import shutil
+import tempfile
 import main
 
 TRAINING_INTERVAL = np.array(range(1961, 2010))
@@ -37,8 +41,207 @@ CITIES = [
 ]
 
 
+def write_sample_csv(directory, name='sample.csv', temps=None):
+	"""
+	Write a small csv file with the layout of data.csv and return its path.
+	"""
+	dates = pd.date_range('2014-12-20', '2015-01-10')
+	if temps is None:
+		temps = np.round(np.linspace(-5, 5, len(dates)), 1)
+	rows = pd.concat([
+		pd.DataFrame({'CITY': city, 'TEMP': temps + shift,
+					  'DATE': dates.strftime('%Y%m%d').astype(int)})
+		for city, shift in [('BOSTON', 0), ('MIAMI', 20)]])
+	rows.iloc[3, 1] = -483
+	path = os.path.join(directory, name)
+	rows.to_csv(path, index=False)
+	return path
+
+
+def expected_temp(df, city, date):
+	"""
+	Look up the temperature of a city and date with a boolean mask.
+	"""
+	return df[(df.CITY == city) & (df.index == date)]['TEMP'].item()
+
+
 class TestClimate(unittest.TestCase):
 
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_cache(self):
+		path = write_sample_csv(self.tmpdir)
+		expected = main.Climate(path, cache=False).get_df()
+
+		first = main.Climate(path).get_df()
+		self.assertTrue(os.path.isdir(main.cache_dir(path)), "cache was not written")
+		cached = main.Climate(path).get_df()
+		pd.testing.assert_frame_equal(first, expected)
+		pd.testing.assert_frame_equal(cached, expected)
+
+		# the offsets and totals are cached with the sorted records, which
+		# are still appended to
+		climate = main.Climate(path)
+		pd.testing.assert_frame_equal(climate.yearly_totals(), main.Climate(path, cache=False).yearly_totals())
+		pd.testing.assert_series_equal(climate.filter_by(cities=['MIAMI'], years=[2015]),
+									   expected[(expected.CITY == 'MIAMI') & (expected.YEAR == 2015)]['TEMP'])
+		climate.append(pd.DataFrame({'CITY': ['MIAMI'], 'TEMP': [30.0], 'DATE': [20150111]}))
+		self.assertEqual(climate.get_daily_temp('MIAMI', 1, 11, 2015), 30.0)
+
+		# touching the file keeps the cache, changing its content rebuilds it
+		os.utime(path, ns=(0, 0))
+		pd.testing.assert_frame_equal(main.Climate(path).get_df(), expected)
+		write_sample_csv(self.tmpdir, temps=np.zeros(22))
+		self.assertTrue((main.Climate(path).get_df().TEMP[:3] == 0).all(), "cache was not rebuilt")
+
+	def test_filter_by(self):
+		climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+		df = climate.get_df()
+		self.assertListEqual(climate.get_cities(), ['BOSTON', 'MIAMI'])
+		self.assertListEqual(climate.get_years(), [2014, 2015])
+
+		result = climate.filter_by(cities=['MIAMI'], years=[2015])
+		expected = df[(df.CITY == 'MIAMI') & (df.YEAR == 2015)]['TEMP']
+		pd.testing.assert_series_equal(result, expected)
+
+		result = climate.filter_by(years=[2014], days=[25, 26])
+		expected = df[(df.YEAR == 2014) & df.DAY.isin([25, 26])]['TEMP']
+		pd.testing.assert_series_equal(result, expected)
+
+		self.assertEqual(climate.get_daily_temp('MIAMI', 1, 2, 2015), expected_temp(df, 'MIAMI', '2015-01-02'))
+		self.assertEqual(len(climate.get_yearly_temp('BOSTON', 2014)), 12)
+		with self.assertRaises(AssertionError):
+			climate.filter_by(cities=['PARIS'])
+		with self.assertRaises(AssertionError):
+			climate.get_daily_temp('BOSTON', 2, 1, 2015)
+
+		dates = ['2015-01-02', '2014-12-20', '2015-01-02', '2016-01-01']
+		temps = climate.get_daily_temps(['MIAMI', 'BOSTON', 'BOSTON', 'BOSTON'], dates)
+		expected = [expected_temp(df, city, date) for city, date in [('MIAMI', '2015-01-02'), ('BOSTON', '2014-12-20'), ('BOSTON', '2015-01-02')]]
+		np.testing.assert_array_equal(temps, expected + [np.nan])
+		with self.assertRaises(AssertionError):
+			climate.get_daily_temps('PARIS', dates)
+
+	def test_append(self):
+		path = write_sample_csv(self.tmpdir)
+		expected = main.Climate(path, cache=False)
+		rows = pd.read_csv(path)
+		old = (rows.DATE < 20150105) & (rows.DATE != 20141225)
+		rows[old & (rows.CITY == 'BOSTON')].to_csv(path, index=False)
+
+		climate = main.Climate(path, cache=False)
+		climate.append(rows[~old & (rows.CITY == 'BOSTON')])  # new days
+		climate.append(rows[old & (rows.CITY == 'MIAMI')])  # new city
+		rows[~old & (rows.CITY == 'MIAMI')].to_csv(path, index=False)
+		climate.append(path)  # csv chunk, with a day in the middle
+
+		pd.testing.assert_frame_equal(climate.get_df(), expected.get_df())
+		self.assertListEqual(climate.get_cities(), expected.get_cities())
+		pd.testing.assert_frame_equal(climate.yearly_totals(), expected.yearly_totals(), check_dtype=False)
+		result = climate.filter_by(cities=['MIAMI'], years=[2014])
+		pd.testing.assert_series_equal(result, expected.filter_by(cities=['MIAMI'], years=[2014]))
+		self.assertEqual(climate.get_daily_temp('BOSTON', 1, 8, 2015), expected.get_daily_temp('BOSTON', 1, 8, 2015))
+		np.testing.assert_allclose(main.gen_cities_avg(climate, ['BOSTON', 'MIAMI'], [2014, 2015]),
+								   main.gen_cities_avg(expected, ['BOSTON', 'MIAMI'], [2014, 2015]))
+
+	def test_stream(self):
+		path = write_sample_csv(self.tmpdir)
+		expected = main.Climate(path, cache=False)
+		climate = main.Climate.stream(path, chunksize=5)
+		self.assertEqual(climate.load_stats['chunks'], 9)
+		self.assertEqual(climate.load_stats['rows'], 44)
+		self.assertEqual(climate.get_df()['TEMP'].dtype, np.float32)
+		self.assertListEqual(climate.get_cities(), expected.get_cities())
+		result = climate.filter_by(cities=['MIAMI'], years=[2015])
+		np.testing.assert_allclose(result.values, expected.filter_by(cities=['MIAMI'], years=[2015]).values, rtol=1e-6)
+		self.assertTrue((climate.get_df().index == expected.get_df().index).all())
+		self.assertEqual(climate.get_df()['TEMP'].min(), expected.get_df()['TEMP'].min())
+
+		# appended records keep the compact dtypes, new cities included
+		dtypes = climate.get_df().dtypes
+		climate.append(pd.DataFrame({'CITY': ['AUSTIN', 'MIAMI'], 'TEMP': [30.5, 25.0],
+									 'DATE': [20150111, 20150111]}))
+		result = climate.get_df().dtypes
+		self.assertListEqual(list(result.drop('CITY')), list(dtypes.drop('CITY')))
+		self.assertIsInstance(result['CITY'], pd.CategoricalDtype)
+		self.assertListEqual(climate.get_cities(), ['AUSTIN', 'BOSTON', 'MIAMI'])
+
+	def test_climatology(self):
+		path = write_sample_csv(self.tmpdir)
+		climate = main.Climate(path, cache=False)
+		history = climate.climatology('MIAMI', percentiles=[50])
+		self.assertIs(climate.climatology('MIAMI', percentiles=[50]), history, "climatology was not memoised")
+
+		temps = climate.filter_by(cities=['MIAMI'])
+		slots = main.day_of_year(temps.index)
+		np.testing.assert_allclose(history['mean'][slots], temps.values)
+		np.testing.assert_allclose(history['p50'][slots], temps.values)
+		self.assertEqual(history['count'].sum(), len(temps))
+		self.assertTrue(np.isnan(history['mean'][100]), "days without records should be NaN")
+
+		# appending records of the city drops its climatologies
+		climate.append(pd.DataFrame({'CITY': ['MIAMI'], 'TEMP': [30.0], 'DATE': [20160101]}))
+		history = climate.climatology('MIAMI', percentiles=[50])
+		self.assertEqual(history['max'][0], 30.0)
+		self.assertEqual(history['count'][0], 2)
+
+		# the cube gives the same statistics, without the missing records
+		climate.append(pd.DataFrame({'CITY': ['MIAMI'], 'TEMP': [np.nan], 'DATE': [20160102]}))
+		self.assertEqual(climate.climatology('MIAMI')['count'][1], 1)
+		cube = main.ClimateCube.from_climate(climate, dtype=np.float64)
+		for baseline in [None, (2015, 2016)]:
+			expected = climate.climatology('MIAMI', baseline, percentiles=[50])
+			result = cube.climatology('MIAMI', baseline, percentiles=[50])
+			self.assertListEqual(sorted(result), sorted(expected))
+			for key in expected:
+				np.testing.assert_allclose(result[key], expected[key])
+
+	def test_anomalies(self):
+		climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+		baseline = (2014, 2014)
+		anomaly = climate.filter_by(cities=['MIAMI'], anomaly=True, baseline=baseline)
+		temps = climate.filter_by(cities=['MIAMI'])
+		self.assertEqual(anomaly.name, 'ANOMALY')
+		# a single baseline year leaves no anomaly on it and none outside it
+		np.testing.assert_allclose(anomaly['2014'].values, 0)
+		self.assertTrue(np.isnan(anomaly['2015'].values).all())
+		self.assertIs(climate.anomalies(baseline), climate.anomalies(baseline), "anomalies were not memoised")
+		cube = main.ClimateCube.from_climate(climate, dtype=np.float64)
+		np.testing.assert_allclose(cube.filter_by(cities=['MIAMI'], anomaly=True, baseline=baseline).values,
+								   anomaly.values, atol=1e-5)
+
+		# appending a record to the baseline moves the mean of its day
+		climate.append(pd.DataFrame({'CITY': ['MIAMI'], 'TEMP': [10.0], 'DATE': [20141225]}))
+		anomaly = climate.filter_by(cities=['MIAMI'], anomaly=True, baseline=baseline)
+		self.assertEqual(len(anomaly), len(temps) + 1)
+		expected = abs(10.0 - temps['2014-12-25'].item()) / 2
+		np.testing.assert_allclose(sorted(anomaly['2014-12-25'].values), [-expected, expected], rtol=1e-6)
+
+		# a sinusoidal cycle is reproduced by its first harmonic
+		days = np.arange(366)
+		cycle = 3 + 2 * np.cos(2 * np.pi * days / 366) - np.sin(2 * np.pi * days / 366)
+		np.testing.assert_allclose(main.harmonic_fit(cycle, np.ones(366), 1), cycle, atol=1e-9)
+
+
+	def test_climate_cube(self):
+		climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+		cube = main.ClimateCube.from_climate(climate, dtype=np.float64)
+		self.assertListEqual(cube.get_cities(), climate.get_cities())
+		self.assertListEqual(cube.get_years(), climate.get_years())
+		for kwargs in [{}, {'cities': ['MIAMI'], 'years': [2015]}, {'years': [2014], 'days': [25]}]:
+			np.testing.assert_array_equal(cube.filter_by(**kwargs).values, climate.filter_by(**kwargs).values)
+		self.assertEqual(cube.get_daily_temp('MIAMI', 1, 2, 2015), climate.get_daily_temp('MIAMI', 1, 2, 2015))
+		dates = ['2014-12-20', '2015-01-10', '2015-01-11']
+		np.testing.assert_array_equal(cube.get_daily_temps('BOSTON', dates), climate.get_daily_temps('BOSTON', dates))
+
+		expected = climate.get_df().groupby(['CITY', 'YEAR'])['TEMP'].mean().unstack().values
+		np.testing.assert_allclose(cube.yearly_mean(), expected)
+		self.assertEqual(main.ClimateCube.from_climate(climate).temps.dtype, np.float32)
+
 	def test_generate_models(self):
 
 		degs_msg = "generate_models should return one model for each given degree"
@@ -79,6 +282,47 @@ class TestClimate(unittest.TestCase):
 			self.assertListEqual(list(models[i]), list(np.polyfit(x,y, degrees[i])), coefficient_mismatch)
 
 
+	def test_fit_models(self):
+		x = np.array(range(1961, 2010))
+		rng = np.random.default_rng(0)
+		ys = np.vstack([0.02 * x + rng.normal(size=len(x)), np.sin(x), 3 - 0.01 * x])
+		fits = main.fit_models(x, ys, [1, 2])
+		self.assertEqual(len(fits), 2)
+
+		for deg, fit in zip([1, 2], fits):
+			self.assertEqual(fit['coefficients'].shape, (3, deg + 1))
+			for i, y in enumerate(ys):
+				model = np.polyfit(x, y, deg)
+				estimated = np.polyval(model, x)
+				np.testing.assert_allclose(fit['coefficients'][i], model, rtol=1e-6, atol=1e-12)
+				self.assertTrue(math.isclose(fit['r_squared'][i], main.r_squared(y, estimated), abs_tol=1e-9))
+				self.assertTrue(math.isclose(fit['rmse'][i], main.rmse(y, estimated), abs_tol=1e-9))
+				if deg == 1:
+					se = main.se_over_slope(x, y, estimated, model)
+					self.assertTrue(math.isclose(fit['se_over_slope'][i], se, rel_tol=1e-6))
+				else:
+					self.assertTrue(np.isnan(fit['se_over_slope'][i]))
+
+	def test_evaluate_models(self):
+		x = np.array(range(1961, 2010))
+		ys = np.vstack([0.02 * x + np.sin(x), 3 - 0.01 * x + np.cos(x)])
+		models = [np.polyfit(x, ys[0], 1), np.polyfit(x, ys[0], 2)]
+		table = main.evaluate_models(x, ys, models)
+		self.assertListEqual(list(table.degree), [1, 1, 2, 2])
+		for row in table.itertuples():
+			estimated = np.polyval(models[row.model], x)
+			y = ys[row.series]
+			self.assertTrue(math.isclose(row.r_squared, main.r_squared(y, estimated)))
+			self.assertTrue(math.isclose(row.rmse, main.rmse(y, estimated)))
+		self.assertTrue(math.isclose(table.se_over_slope[1], main.se_over_slope(x, ys[1], np.polyval(models[0], x), models[0])))
+		self.assertTrue(np.isnan(table.se_over_slope[2:]).all())
+		np.testing.assert_allclose(main.r_squared(ys, np.polyval(models[0], x)), table.r_squared[:2])
+
+		path = os.path.join(self.tmpdir, 'training.pdf')
+		table = main.evaluate_models_on_training(x, ys[0], models, path)
+		self.assertEqual(len(table), 2)
+		self.assertTrue(os.path.getsize(path) > 0)
+
 	def test_r_squared(self):
 
 		# basic case:
@@ -149,6 +393,17 @@ class TestClimate(unittest.TestCase):
 		result = main.moving_average(y, window_length)
 		self.assertListEqual(list(result), list(correct), "Moving average values incorrect")
 
+		# one series per row, or per column with axis=0
+		y = np.array([[1, 2, 3, 4, 5, 6, 7], [-1.5, 1.5, -3.0, 3.0, -4.5, 4.5, 0]])
+		correct = np.array([[1, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5], [-1.5, 0, -.75, 0, -.75, 0, 2.25]])
+		np.testing.assert_allclose(main.moving_average(y, 2), correct)
+		np.testing.assert_allclose(main.moving_average(y.T, 2, axis=0), correct.T)
+
+		# a NaN only spoils the windows that contain it
+		y = [1, np.nan, 3, 4, 5, 6]
+		np.testing.assert_array_equal(main.moving_average(y, 1), y)
+		np.testing.assert_array_equal(main.moving_average(y, 2), [1, np.nan, np.nan, 3.5, 4.5, 5.5])
+
 	def test_rmse(self):
 		y = [1, 2, 3, 4, 5, 6, 7, 8, 9]
 		estimate = [1, 4, 9, 16, 25, 36, 49, 64, 81]
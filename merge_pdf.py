@@ -8,57 +8,112 @@ Created on Sat Apr 17 14:08:33 2021
 
 
 import os
-from PyPDF2 import PdfFileMerger
+from concurrent.futures import ProcessPoolExecutor
+from PyPDF2 import PdfReader, PdfWriter
 
-def merge_pdf(foldername, foldername_end, folder_location=''):
-        
+
+def merge_jobs(directory, dir_end, force=False):
+    """
+    List the merges to do: one per city folder inside directory, named after
+    the folder. A city is skipped when its merged pdf is newer than all of
+    its pdfs, unless force is True.
+
+    Args:
+        directory: absolute path of the folder with the cities folders (str).
+        dir_end: absolute path of the folder of the merged pdfs (str).
+        force: merge the cities even if they are up to date (bool).
+
+    Returns:
+        a list of (list of pdf paths, merged pdf path) tuples.
+    """
+    jobs = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_dir():
+            continue
+        files = sorted(os.path.join(entry.path, file)
+                       for file in os.listdir(entry.path)
+                       if file.lower().endswith('.pdf'))
+        if not files:
+            continue
+        dir_file = os.path.join(dir_end, entry.name + '.pdf')
+        if (not force and os.path.exists(dir_file) and
+                os.path.getmtime(dir_file) >= max(map(os.path.getmtime, files))):
+            continue
+        jobs.append((files, dir_file))
+    return jobs
+
+
+def merge_files(files, dir_file):
     """
-    Given a folder with city folders inside it, merge the pdfs that are inside 
-    each city folder into one new pdf file and name them according to the city. 
-    Saved all files inside the folder named 'foldername_end'.
-    
+    Merge the pdf files into dir_file. The inputs are read one at a time:
+    the pages of each are copied into the writer and the file is closed
+    before the next one is opened. PyPDF2 writes a document in one pass, so
+    the copied pages are held by the writer until the output is written.
+    It is written to a temporary file, renamed to dir_file once complete,
+    so an interrupted merge never leaves a truncated pdf that looks up to
+    date.
+
+    Args:
+        files: list of absolute paths of the pdfs to merge (str).
+        dir_file: absolute path of the merged pdf (str).
+
+    Returns:
+        dir_file.
+    """
+    partial = dir_file + '.part'
+    writer = PdfWriter()
+    for file in files:
+        with open(file, 'rb') as f:
+            for page in PdfReader(f).pages:
+                writer.add_page(page)
+    with open(partial, 'wb') as output:
+        writer.write(output)
+    os.replace(partial, dir_file)
+    return dir_file
+
+
+def _merge_job(job):
+    return merge_files(*job)
+
+
+def merge_pdf(foldername, foldername_end, folder_location='', processes=None,
+              force=False):
+    """
+    Given a folder with city folders inside it, merge the pdfs that are inside
+    each city folder into one new pdf file and name them according to the city.
+    Saved all files inside the folder named 'foldername_end'. The cities are
+    merged in a pool of processes, and those whose merged pdf is up to date
+    are skipped (see merge_jobs).
+
     Args:
         foldername: Name of the folder where the cities folders are located (str)
         foldername_end: Name of the folder where the merge file will be saved (str).
-        folder_location: directory where 'foldername' is located. By default 
-        it takes the current working directory (str).        
-        
+        folder_location: directory where 'foldername' is located. By default
+        it takes the current working directory (str).
+        processes: number of processes, the number of CPUs by default.
+        force: merge the cities even if they are up to date (bool).
+
     Retunrs:
-        None.
-     
+        the list of the merged pdf files.
+
     """
-    
+
     #Create necessary directories.
-    if not folder_location:
-        cwd = os.getcwd()  # cwd is the place where the folder calendar_plots is.
-    else:
-        cwd = folder_location
+    cwd = os.path.abspath(folder_location or os.getcwd())
     directory = os.path.join(cwd, foldername)
     dir_end = os.path.join(cwd, foldername_end)
-    
+
     #Create the destination folder if it does not exist
-    if not os.path.isdir(dir_end):
-        os.mkdir(dir_end)
-    
-    #Create a dictionary with cities as keys and a list of pdfs as values
-    pdfs = {}
-    for root, dirs, files in os.walk(directory):
-        if files:
-            name = files[0][:-8]
-            pdfs[name] = sorted(files)
-    
-    #Merge pdf from each dity and locate them in the folder 'calendar_plots_unified'
-    for key in pdfs:
-        os.chdir(os.path.join(directory, key)) 
-        merger = PdfFileMerger()
-        for file in pdfs[key]:
-            merger.append(file)
-        filename = key + '.pdf'
-        dir_file = os.path.join(dir_end, filename)
-        merger.write(dir_file)
-        merger.close()
+    os.makedirs(dir_end, exist_ok=True)
+
+    #Merge the pdfs of each city in the folder 'foldername_end'
+    jobs = merge_jobs(directory, dir_end, force)
+    if not jobs:
+        return []
+    with ProcessPoolExecutor(min(processes or os.cpu_count() or 1, len(jobs))) as pool:
+        return list(pool.map(_merge_job, jobs))
 
 if __name__ == '__main__':
     foldername = 'calendar_plots'
     foldername_end = 'calendar_plots_unified'
-    merge_pdf(foldername,  foldername_end)
\ No newline at end of file
+    merge_pdf(foldername,  foldername_end)
@@ -0,0 +1,71 @@
+"""
+Tests of the merge of the pdfs of each city.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+from PyPDF2 import PdfReader, PdfWriter
+import merge_pdf
+
+
+def write_pdf(path, pages):
+	"""
+	Write a pdf with the given number of blank pages.
+	"""
+	writer = PdfWriter()
+	for _ in range(pages):
+		writer.add_blank_page(72, 72)
+	with open(path, 'wb') as f:
+		writer.write(f)
+
+
+class TestMergePdf(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.directory = os.path.join(self.tmpdir, 'calendar_plots')
+		self.dir_end = os.path.join(self.tmpdir, 'calendar_plots_unified')
+		for city, pages in [('BOSTON', [1, 2]), ('MIAMI', [3])]:
+			os.makedirs(os.path.join(self.directory, city))
+			for year, n in zip([2015, 2014], pages):
+				write_pdf(os.path.join(self.directory, city, '%s%d.pdf' % (city, year)), n)
+		os.makedirs(os.path.join(self.directory, 'EMPTY'))
+		open(os.path.join(self.directory, 'notes.txt'), 'w').close()
+		open(os.path.join(self.directory, 'MIAMI', 'notes.txt'), 'w').close()
+		os.makedirs(self.dir_end)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_merge_jobs(self):
+		jobs = merge_pdf.merge_jobs(self.directory, self.dir_end)
+		boston = os.path.join(self.directory, 'BOSTON')
+		self.assertListEqual(jobs, [
+			([os.path.join(boston, 'BOSTON2014.pdf'), os.path.join(boston, 'BOSTON2015.pdf')],
+			 os.path.join(self.dir_end, 'BOSTON.pdf')),
+			([os.path.join(self.directory, 'MIAMI', 'MIAMI2015.pdf')],
+			 os.path.join(self.dir_end, 'MIAMI.pdf'))])
+
+		# merged pdfs newer than their inputs are skipped, unless forced
+		for job in jobs:
+			merge_pdf._merge_job(job)
+		self.assertListEqual(merge_pdf.merge_jobs(self.directory, self.dir_end), [])
+		self.assertEqual(len(merge_pdf.merge_jobs(self.directory, self.dir_end, force=True)), 2)
+		os.utime(os.path.join(self.dir_end, 'MIAMI.pdf'), (0, 0))
+		jobs = merge_pdf.merge_jobs(self.directory, self.dir_end)
+		self.assertListEqual([dir_file for _, dir_file in jobs], [os.path.join(self.dir_end, 'MIAMI.pdf')])
+
+	def test_merge_pdf(self):
+		paths = merge_pdf.merge_pdf('calendar_plots', 'calendar_plots_unified',
+									folder_location=self.tmpdir, processes=1)
+		self.assertListEqual([os.path.basename(path) for path in paths], ['BOSTON.pdf', 'MIAMI.pdf'])
+		self.assertListEqual([len(PdfReader(path).pages) for path in paths], [3, 3])
+		self.assertListEqual(sorted(os.listdir(self.dir_end)), ['BOSTON.pdf', 'MIAMI.pdf'])
+		self.assertListEqual(merge_pdf.merge_pdf('calendar_plots', 'calendar_plots_unified',
+												 folder_location=self.tmpdir, processes=1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Warming trends of the cities: fitted trends and their bootstrap confidence
+intervals.
+
+The trend of a city is the least squares slope of its mean temperature
+against the years, for the whole year, each month or each season. The
+slopes of all the resamples are computed at once in closed form from
+weighted sums, instead of one np.polyfit per resample.
+
+trend_table fits polynomial trends of every city, period and yearly
+statistic (mean, min, max, std), batching the series that share the same
+years into one least squares solve.
+
+backtest cross-validates the polynomial trend models on rolling-origin
+splits of a series, with an expanding or a rolling training window.
+"""
+
+import calendar
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import main
+
+
+PERIODS = dict([('year', list(range(1, 13)))] +
+               [(calendar.month_abbr[m], [m]) for m in range(1, 13)] +
+               [('DJF', [12, 1, 2]), ('MAM', [3, 4, 5]), ('JJA', [6, 7, 8]),
+                ('SON', [9, 10, 11])])
+STATISTICS = ('mean', 'min', 'max', 'std')
+
+
+def period_stats(climate, cities=None, periods=None, stats=STATISTICS):
+    """
+    Compute statistics of the daily temperatures of each city, period and
+    year from the monthly totals of the climate (see
+    Climate.monthly_totals). The winter (DJF) of a year takes the December
+    of the previous calendar year. A period is NaN in the years where one of its
+    months has no records.
+
+    Args:
+        climate: a climate object.
+        cities: list of city names, all of them by default.
+        periods: list of period names (keys of PERIODS), all of them by
+            default.
+        stats: list of statistics among 'mean', 'min', 'max' and 'std' (the
+            standard deviation of the daily temperatures, ddof=1).
+
+    Returns:
+        a tuple (cities, periods, stats, years, values) where values is a
+        (cities x periods x stats x years) np array.
+    """
+    totals = climate.monthly_totals()
+    cities = totals['cities'] if cities is None else list(cities)
+    periods = list(PERIODS) if periods is None else list(periods)
+    stats = list(stats)
+    assert set(cities).issubset(totals['cities']), "provided city is not available"
+    assert set(periods).issubset(PERIODS), "provided period is not available"
+    assert set(stats).issubset(STATISTICS), "provided statistic is not available"
+    rows = [totals['cities'].index(city) for city in cities]
+
+    # Month 12 is the December of the previous year, for the winters. It has
+    # no records when the previous year is missing from the years.
+    consecutive = np.diff(totals['years']) == 1
+    cube = {}
+    for key in ['count', 'sum', 'sumsq', 'min', 'max']:
+        array = totals[key][rows].astype(float)
+        fill = np.nan if key in ('min', 'max') else 0
+        december = np.full(array.shape[:2] + (1,), fill)
+        december[:, 1:, 0] = np.where(consecutive, array[:, :-1, 11], fill)
+        cube[key] = np.concatenate([array, december], axis=2)
+
+    values = np.empty((len(cities), len(periods), len(stats), len(totals['years'])))
+    for j, period in enumerate(periods):
+        months = [12 if period == 'DJF' and m == 12 else m - 1
+                  for m in PERIODS[period]]
+        count = cube['count'][..., months].sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = cube['sum'][..., months].sum(axis=2) / count
+            squares = cube['sumsq'][..., months].sum(axis=2)
+            results = {'mean': mean,
+                       'min': cube['min'][..., months].min(axis=2),
+                       'max': cube['max'][..., months].max(axis=2),
+                       'std': np.sqrt(np.maximum(squares - count * mean**2, 0)
+                                      / (count - 1))}
+        missing = (cube['count'][..., months] == 0).any(axis=2)
+        for k, stat in enumerate(stats):
+            values[:, j, k] = np.where(missing, np.nan, results[stat])
+    return cities, periods, stats, totals['years'], values
+
+
+def period_means(climate, cities=None, periods=None):
+    """
+    Compute the mean temperature of each city, period and year (see
+    period_stats).
+
+    Returns:
+        a tuple (cities, periods, years, means) where means is a
+        (cities x periods x years) np array.
+    """
+    cities, periods, _, years, values = period_stats(climate, cities, periods, ['mean'])
+    return cities, periods, years, values[:, :, 0]
+
+
+def resample_indices(n, n_boot, block=1, rng=None):
+    """
+    Draw the indices of n_boot resamples of n observations as one array.
+    With block > 1, the resamples are made of moving blocks of block
+    consecutive observations, which keeps the autocorrelation of the series
+    within each block.
+
+    Args:
+        n: number of observations (int).
+        n_boot: number of resamples (int).
+        block: length of the blocks (int).
+        rng: a np.random.Generator, by default a new unseeded one.
+
+    Returns:
+        a (n_boot x n) np array of ints.
+    """
+    rng = np.random.default_rng(rng)
+    block = min(block, n)
+    if block == 1:
+        return rng.integers(0, n, (n_boot, n))
+    n_blocks = -(-n // block)
+    starts = rng.integers(0, n - block + 1, (n_boot, n_blocks))
+    indices = starts[:, :, None] + np.arange(block)
+    return indices.reshape(n_boot, -1)[:, :n]
+
+
+def batch_slopes(x, y, indices=None):
+    """
+    Compute the least squares slopes of several series in closed form. The
+    missing values (NaN) of y are left out of the fits.
+
+    Args:
+        x: np array of the n abscissas (e.g. the years).
+        y: (series x n) np array of the ordinates.
+        indices: (resamples x n) np array of the indices of the resamples,
+            see resample_indices. By default, the series are fitted as they
+            are.
+
+    Returns:
+        a (series) np array of slopes, or (series x resamples) if indices
+        is given. NaN where a fit has less than two distinct abscissas.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x - x.mean()  # avoids the cancellation of the sums of squares
+    y = np.asarray(y, dtype=float)
+    if indices is not None:
+        x, y = x[indices], y[:, indices]
+    weight = ~np.isnan(y)
+    y = np.where(weight, y, 0)
+    x = np.broadcast_to(x, y.shape) * weight
+    count = weight.sum(axis=-1)
+    sx, sy = x.sum(axis=-1), y.sum(axis=-1)
+    sxx, sxy = (x * x).sum(axis=-1), (x * y).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denominator = count * sxx - sx**2
+        return np.where(denominator > 1e-9 * count * sxx,
+                        (count * sxy - sx * sy) / denominator, np.nan)
+
+
+def _ci_job(job):
+    """
+    Compute the slopes and confidence intervals of the periods of a city.
+    """
+    city, periods, years, means, n_boot, block, alpha, seed = job
+    indices = resample_indices(len(years), n_boot, block, np.random.default_rng(seed))
+    slopes = batch_slopes(years, means, indices)
+    with warnings.catch_warnings():
+        # Periods without records have no slopes.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanpercentile(
+            slopes, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+        std = np.nanstd(slopes, axis=1, ddof=1)
+    return pd.DataFrame({'CITY': city, 'PERIOD': periods,
+                         'slope': batch_slopes(years, means),
+                         'lower': lower, 'upper': upper, 'std': std,
+                         'years': (~np.isnan(means)).sum(axis=1)})
+
+
+def slope_ci(climate, cities=None, periods=None, n_boot=1000, block=1,
+             alpha=0.05, seed=0, processes=1):
+    """
+    Compute bootstrap confidence intervals of the trend slope of every city
+    and period. All the resamples of a city are drawn as one array of
+    indices and fitted together (see batch_slopes); the cities are spread
+    over a pool of processes. Each city draws from its own child of
+    np.random.SeedSequence(seed), so the intervals only depend on seed, not
+    on the number of processes.
+
+    Args:
+        climate: a climate object.
+        cities: list of city names, all of them by default.
+        periods: list of period names (keys of PERIODS), all of them by
+            default.
+        n_boot: number of resamples (int).
+        block: length of the blocks of years of the block bootstrap (int),
+            1 for the ordinary bootstrap.
+        alpha: the intervals cover 1 - alpha (float).
+        seed: seed of the resamples (int).
+        processes: number of processes (int), None for the number of CPUs.
+
+    Returns:
+        a data frame with the columns CITY, PERIOD, slope (the least squares
+        slope, °C per year), lower and upper (the percentile interval), std
+        (the bootstrap standard error) and years (the years with data).
+    """
+    cities, periods, years, means = period_means(climate, cities, periods)
+    seeds = np.random.SeedSequence(seed).spawn(len(cities))
+    jobs = [(city, periods, years, means[i], n_boot, block, alpha, seeds[i])
+            for i, city in enumerate(cities)]
+    if processes == 1:
+        tables = list(map(_ci_job, jobs))
+    else:
+        with ProcessPoolExecutor(min(processes or os.cpu_count() or 1,
+                                     len(jobs))) as pool:
+            tables = list(pool.map(_ci_job, jobs))
+    return pd.concat(tables, ignore_index=True)
+
+
+def trend_table(climate, cities=None, periods=None, stats=STATISTICS,
+                degs=(1, 2)):
+    """
+    Fit the trend of every city, period and statistic against the years, for
+    each polynomial degree. The yearly statistics are computed at once (see
+    period_stats) and the series sharing the same years with data are
+    fitted together in one batched least squares solve (see
+    main.fit_models).
+
+    Args:
+        climate: a climate object.
+        cities: list of city names, all of them by default.
+        periods: list of period names (keys of PERIODS), all of them by
+            default.
+        stats: list of statistics (see period_stats).
+        degs: list of degrees of the fitted polynomials.
+
+    Returns:
+        a data frame with the columns CITY, PERIOD, STAT, DEGREE, slope (the
+        mean rate of change of the fit over the years, °C per year, the
+        slope itself for degree 1), r_squared, rmse, se_over_slope (NaN
+        unless the degree is 1) and years (the years with data). The fits
+        with too few years are NaN.
+    """
+    cities, periods, stats, years, values = period_stats(climate, cities, periods, stats)
+    shape = values.shape[:3]
+    series = values.reshape(-1, len(years))
+    x = years.astype(float)
+
+    columns = ['slope', 'r_squared', 'rmse', 'se_over_slope']
+    results = np.full((len(degs), len(series), len(columns)), np.nan)
+    masks, pattern = np.unique(~np.isnan(series), axis=0, return_inverse=True)
+    for p, mask in enumerate(masks):
+        rows = np.flatnonzero(pattern.ravel() == p)
+        fits = [(i, deg) for i, deg in enumerate(degs) if mask.sum() > deg + 1]
+        if not fits:
+            continue
+        xs = x[mask]
+        models = main.fit_models(xs, series[rows][:, mask], [deg for _, deg in fits])
+        for (i, deg), model in zip(fits, models):
+            estimated = model['estimated']
+            slope = (estimated[:, -1] - estimated[:, 0]) / (xs[-1] - xs[0])
+            results[i, rows] = np.column_stack(
+                [slope, model['r_squared'], model['rmse'], model['se_over_slope']])
+
+    index = pd.MultiIndex.from_product([cities, periods, stats],
+                                       names=['CITY', 'PERIOD', 'STAT'])
+    tables = []
+    for i, deg in enumerate(degs):
+        table = pd.DataFrame(results[i], index=index, columns=columns)
+        table.insert(0, 'DEGREE', deg)
+        table['years'] = (~np.isnan(series)).sum(axis=1)
+        tables.append(table.reset_index())
+    return pd.concat(tables, ignore_index=True)
+
+
+def _backtest_job(job):
+    """
+    Score every scheme and degree for one smoothing window. The normal
+    equations of each training span are differences of prefix sums of the
+    powers of x and of x**k * y, so every split costs O(1) whatever its
+    length, and all the splits are solved at once.
+    """
+    x, y, degs, window, horizon, min_train, schemes = job
+    smoothed = main.moving_average(y, window)
+    # Scaled abscissas keep the sums of powers well conditioned.
+    u = (x - x.mean()) / max(np.ptp(x) / 2, 1)
+    top = max(degs)
+    powers = u[:, None] ** np.arange(2 * top + 1)
+    moments = np.vstack([np.zeros(2 * top + 1), np.cumsum(powers, axis=0)])
+    products = np.vstack([np.zeros(top + 1),
+                          np.cumsum(powers[:, :top + 1] * smoothed[:, None], axis=0)])
+
+    origins = np.arange(min_train, len(x) - horizon + 1)  # first tested year
+    tested = origins[:, None] + np.arange(horizon)
+    actual = smoothed[tested]
+    ss_tot = np.sum((actual - actual.mean())**2)
+    rows = []
+    for scheme in schemes:
+        starts = np.zeros_like(origins) if scheme == 'expanding' else origins - min_train
+        sums = moments[origins] - moments[starts]
+        rhs = products[origins] - products[starts]
+        for deg in degs:
+            k = np.arange(deg + 1)
+            coefficients = np.linalg.solve(sums[:, k[:, None] + k],
+                                           rhs[:, :deg + 1, None])[..., 0]
+            estimated = np.einsum('sht,st->sh', powers[tested][..., :deg + 1],
+                                  coefficients)
+            sse = np.sum((actual - estimated)**2)
+            rows.append({'scheme': scheme, 'DEGREE': deg, 'window': window,
+                         'splits': len(origins),
+                         'rmse': np.sqrt(sse / actual.size),
+                         'r_squared': 1 - sse / ss_tot})
+    return rows
+
+
+def backtest(x, y, degs=(1, 2), windows=(1, 5), horizon=1, min_train=10,
+             schemes=('expanding', 'rolling'), processes=1):
+    """
+    Cross-validate the polynomial trend models of y against x on every split
+    of the series: each split trains on the years before an origin and tests
+    on the horizon years from it. The expanding scheme trains on all the
+    previous years, the rolling one on the last min_train years. The models
+    are fitted to the moving average of y (see main.moving_average), which
+    only looks at the previous years, and scored against it, as in the Part
+    A/B pipeline.
+
+    Args:
+        x: an 1-d np array of the years
+        y: an 1-d np array of the values of the years, without NaN
+        degs: list of degrees of the fitted polynomials
+        windows: list of moving average window lengths
+        horizon: number of years tested after each origin (int)
+        min_train: number of training years of the first split, and of
+            every split of the rolling scheme (int)
+        schemes: 'expanding' and/or 'rolling'
+        processes: number of processes over the windows (int), None for the
+            number of CPUs.
+
+    Returns:
+        a data frame with a row per scheme, degree and window, and the
+        columns splits, rmse and r_squared of the tested values of all the
+        splits.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    assert set(schemes).issubset(['expanding', 'rolling']), "provided scheme is not available"
+    assert min_train > max(degs) and min_train + horizon <= len(x), \
+        "not enough years for the splits"
+    jobs = [(x, y, list(degs), window, horizon, min_train, list(schemes))
+            for window in windows]
+    if processes == 1:
+        results = list(map(_backtest_job, jobs))
+    else:
+        with ProcessPoolExecutor(min(processes or os.cpu_count() or 1,
+                                     len(jobs))) as pool:
+            results = list(pool.map(_backtest_job, jobs))
+    table = pd.DataFrame([row for rows in results for row in rows])
+    return table.sort_values(['scheme', 'DEGREE', 'window'], ignore_index=True)
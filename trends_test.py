@@ -0,0 +1,126 @@
+"""
+Tests of the bootstrap confidence intervals of the trends.
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import tempfile
+import main
+import trends
+from main_test import write_sample_csv
+
+
+def write_trend_csv(directory, name='trend.csv'):
+	"""
+	Write the January, February and December 2000-2009 temperatures of two cities, BOSTON
+	warming by 0.1 degrees a year and MIAMI by 0.2, and return the path.
+	"""
+	dates = pd.date_range('2000-01-01', '2009-12-31')
+	dates = dates[dates.month.isin([1, 2, 12])]
+	noise = np.random.default_rng(0).normal(0, 0.05, len(dates))
+	rows = pd.concat([pd.DataFrame({'CITY': city, 'DATE': dates.strftime('%Y%m%d').astype(int),
+									'TEMP': slope * (dates.year - 2000) + noise})
+					  for city, slope in [('BOSTON', 0.1), ('MIAMI', 0.2)]])
+	path = os.path.join(directory, name)
+	rows.to_csv(path, index=False)
+	return path
+
+
+class TestTrends(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_period_means(self):
+		climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+		cities, periods, years, means = trends.period_means(climate, ['MIAMI'], ['Jan', 'Dec', 'DJF'])
+		temps = climate.filter_by(cities=['MIAMI'])
+		self.assertListEqual(list(years), [2014, 2015])
+		self.assertAlmostEqual(means[0, 0, 1], temps['2015-01'].mean())
+		self.assertAlmostEqual(means[0, 1, 0], temps['2014-12'].mean())
+		self.assertTrue(np.isnan(means[0, 0, 0]))
+		self.assertTrue(np.isnan(means[0, 2]).all())  # no February
+
+		# without its previous year, a winter has no December
+		path = write_trend_csv(self.tmpdir)
+		rows = pd.read_csv(path)
+		rows[rows.DATE // 10000 != 2004].to_csv(path, index=False)
+		climate = main.Climate(path, cache=False)
+		cities, periods, years, means = trends.period_means(climate, ['BOSTON'], ['DJF'])
+		self.assertNotIn(2004, list(years))
+		self.assertTrue(np.isnan(means[0, 0, list(years).index(2005)]))
+		self.assertEqual(np.isnan(means[0, 0]).sum(), 2)
+
+	def test_period_stats(self):
+		climate = main.Climate(write_sample_csv(self.tmpdir), cache=False)
+		cities, periods, stats, years, values = trends.period_stats(climate, ['BOSTON', 'MIAMI'], ['Jan'])
+		self.assertListEqual(stats, list(trends.STATISTICS))
+		temps = climate.filter_by(cities=['BOSTON'])['2015-01']
+		np.testing.assert_allclose(values[0, 0, :, 1], [temps.mean(), temps.min(), temps.max(), temps.std()])
+
+	def test_resample_indices(self):
+		indices = trends.resample_indices(10, 50, block=3, rng=0)
+		self.assertEqual(indices.shape, (50, 10))
+		np.testing.assert_array_equal(np.diff(indices[:, :3], axis=1), 1)
+		np.testing.assert_array_equal(indices, trends.resample_indices(10, 50, block=3, rng=0))
+
+	def test_batch_slopes(self):
+		x = np.arange(2000, 2010)
+		y = np.vstack([2 * x + 1, np.sin(x)])
+		y[1, 3] = np.nan
+		valid = ~np.isnan(y[1])
+		np.testing.assert_allclose(trends.batch_slopes(x, y), [2, np.polyfit(x[valid], y[1, valid], 1)[0]])
+		slopes = trends.batch_slopes(x, y, trends.resample_indices(10, 100, rng=0))
+		self.assertEqual(slopes.shape, (2, 100))
+		np.testing.assert_allclose(slopes[0][~np.isnan(slopes[0])], 2)
+
+	def test_slope_ci(self):
+		climate = main.Climate(write_trend_csv(self.tmpdir), cache=False)
+		table = trends.slope_ci(climate, periods=['Jan', 'Dec', 'DJF'], n_boot=200, block=2, seed=1)
+		self.assertListEqual(list(table.CITY), ['BOSTON'] * 3 + ['MIAMI'] * 3)
+		np.testing.assert_allclose(table.slope, [0.1] * 3 + [0.2] * 3, atol=0.01)
+		self.assertTrue(((table.lower < table.slope) & (table.slope < table.upper)).all())
+		self.assertListEqual(list(table.years), [10, 10, 9] * 2)
+		pd.testing.assert_frame_equal(table, trends.slope_ci(climate, periods=['Jan', 'Dec', 'DJF'], n_boot=200, block=2, seed=1, processes=2))
+
+	def test_trend_table(self):
+		climate = main.Climate(write_trend_csv(self.tmpdir), cache=False)
+		table = trends.trend_table(climate, periods=['Jan', 'DJF'], stats=['mean', 'max'])
+		self.assertEqual(len(table), 2 * 2 * 2 * 2)
+		self.assertListEqual(list(table.columns), ['CITY', 'PERIOD', 'STAT', 'DEGREE', 'slope', 'r_squared', 'rmse', 'se_over_slope', 'years'])
+		linear = table[table.DEGREE == 1].set_index(['CITY', 'PERIOD', 'STAT'])
+		np.testing.assert_allclose(linear.slope.loc['MIAMI'], 0.2, atol=0.01)
+		self.assertTrue((linear.r_squared > 0.9).all())
+		self.assertListEqual(list(linear.years.loc['BOSTON']), [10, 10, 9, 9])
+
+		cities, periods, stats, years, values = trends.period_stats(climate, ['BOSTON'], ['DJF'], ['max'])
+		valid = ~np.isnan(values[0, 0, 0])
+		coefficients = np.polyfit(years[valid], values[0, 0, 0, valid], 2)
+		quadratic = table[(table.DEGREE == 2) & (table.CITY == 'BOSTON') & (table.PERIOD == 'DJF') & (table.STAT == 'max')]
+		estimated = np.polyval(coefficients, years[valid][[0, -1]])
+		self.assertAlmostEqual(quadratic.slope.iloc[0], (estimated[1] - estimated[0]) / 8)
+		self.assertTrue(np.isnan(quadratic.se_over_slope.iloc[0]))
+
+	def test_backtest(self):
+		x = np.arange(1961, 2016)
+		y = 0.02 * (x - 1961) + np.sin(x)
+		table = trends.backtest(x, y, degs=[1, 2], windows=[1, 3], horizon=2, min_train=8)
+		self.assertEqual(len(table), 2 * 2 * 2)
+		self.assertTrue((table.splits == 55 - 8 - 2 + 1).all())
+
+		row = table[(table.scheme == 'rolling') & (table.DEGREE == 2) & (table.window == 3)].iloc[0]
+		smoothed = main.moving_average(y, 3)
+		errors = np.concatenate([smoothed[o:o + 2] - np.polyval(np.polyfit(x[o - 8:o], smoothed[o - 8:o], 2), x[o:o + 2])
+								 for o in range(8, 54)])
+		self.assertAlmostEqual(row.rmse, np.sqrt(np.mean(errors**2)))
+		pd.testing.assert_frame_equal(table, trends.backtest(x, y, degs=[1, 2], windows=[1, 3], horizon=2, min_train=8, processes=2))
+
+
+if __name__ == '__main__':
+    unittest.main()